@@ -0,0 +1,56 @@
+'''
+Start-up benchmark of the command line interface
+checks that the light commands stay within the import-time budget
+and never load numpy
+    $ python benchmarks/import_time.py [budget in seconds]
+'''
+
+import os, sys, time, tempfile, subprocess
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIGHT = [['status'], ['submit', '--help']]
+HEAVY = ['numpy', 'utils.vasp', 'utils.experiment', 'utils.structure']
+
+
+def startup(argv, repeat=5):
+    '''the best wall time of `python -m utils <argv>` over repeats'''
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.time()
+        subprocess.check_call([sys.executable, '-m', 'utils'] + argv,
+                              cwd=ROOT, stdout=subprocess.DEVNULL)
+        best = min(best, time.time() - t0)
+    return best
+
+
+def imported(argv):
+    '''the modules imported by `python -m utils <argv>`'''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'utils'] + argv,
+                          cwd=ROOT, stdout=subprocess.DEVNULL, 
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    return set(line.rpartition('|')[2].strip() 
+               for line in proc.stderr.splitlines())
+
+
+def main(budget=0.3):
+    set_dir = tempfile.mkdtemp()
+    baseline = startup(['--help'])
+    failed = False
+    for argv in LIGHT:
+        if argv == ['status']:
+            argv = ['status', set_dir]
+        seconds = startup(argv)
+        heavy = sorted(set(HEAVY) & imported(argv))
+        ok = seconds <= budget and not heavy
+        failed = failed or not ok
+        print('{:<6s}{:>8.3f}s (baseline {:.3f}s) {:<30s}{}'.format(
+            'ok' if ok else 'FAIL', seconds, baseline, ' '.join(argv[:1]),
+            'imports ' + ', '.join(heavy) if heavy else ''))
+    os.rmdir(set_dir)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 0.3
+    sys.exit(main(budget))
@@ -0,0 +1,4 @@
+import sys
+from utils import cli
+
+sys.exit(cli.main())
@@ -0,0 +1,98 @@
+'''
+Submission backends for experiment sets
+the same driver code submits a set either to Slurm or to the local machine
+'''
+
+import os, time, subprocess
+from utils import manifest, submit_exhaustive
+
+
+
+class Backend:
+    '''submits batch files and collects the outcome'''
+
+    def run(self, fpathlist, outcomes=None):
+        '''returns {<batch file path>: <outcome>}, filled into outcomes
+            as each one arrives, so that the caller still has the outcomes
+            so far if a submission fails halfway'''
+        raise NotImplementedError
+
+    def record(self, records, outcomes):
+        '''writes the outcomes into a SetManifest'''
+        raise NotImplementedError
+
+
+
+class SlurmBackend(Backend):
+    '''submits each batch file by sbatch, the outcome is the job ID'''
+
+    def __init__(self, sbatch='sbatch'):
+        self.sbatch = sbatch
+        self.submitted = None
+
+    def run(self, fpathlist, outcomes=None):
+        # every output of these jobs is written after this time
+        self.submitted = time.time()
+        outcomes = {} if outcomes is None else outcomes
+        for fpath in fpathlist:
+            fdir = os.path.dirname(os.path.abspath(fpath))
+            message = subprocess.check_output(
+                [self.sbatch, os.path.abspath(fpath)], cwd=fdir)
+            outcomes[fpath] = message.decode().split()[-1]
+        return outcomes
+
+    def record(self, records, outcomes):
+        for fpath, jobid in outcomes.items():
+            exp_name = os.path.basename(os.path.dirname(fpath))
+            records.update(exp_name, status='submitted', jobid=jobid,
+                           submitted=self.submitted)
+
+
+
+class LocalBackend(Backend):
+    '''runs each batch file on the current machine, scheduled by 
+        the PackedRunner of submit_exhaustive.py as in the packing mode,
+        a job takes as many of the ncores as its "-n" asks for (at most ncores),
+        the outcome is the exit status'''
+
+    def __init__(self, ncores=None, interval=0.5):
+        if ncores is None:
+            ncores = os.cpu_count() or 1
+        self.ncores = ncores
+        self.interval = interval
+
+    def run(self, fpathlist, outcomes=None):
+        runner = submit_exhaustive.PackedRunner(
+            self.ncores, step=None, launcher='bash {script}', 
+            interval=self.interval, outname='job_local', clamp=True, echo=False)
+        if outcomes is not None:
+            runner.status = outcomes
+        return runner.run(fpathlist)
+
+    def record(self, records, outcomes):
+        for fpath, code in outcomes.items():
+            exp_name = os.path.basename(os.path.dirname(fpath))
+            records.update(exp_name, status='completed' if code == 0 else 'failed')
+
+
+
+def submit_set(set_dir, backend, depth=2,
+               match=lambda fn:fn.endswith('.sh'), force=False):
+    '''submits all pending batch files of a set through the backend,
+        and records the outcome in the SetManifest of the set,
+        the experiments already submitted are skipped unless force is set,
+        if the backend fails halfway, the outcomes so far are still recorded'''
+    skip = ('completed',) if force else ('completed', 'submitted')
+    fpathlist = submit_exhaustive.pending(
+        set_dir, submit_exhaustive.exhaust(set_dir, depth, match), skip)
+    fpathlist = sorted(fpath for fpath in fpathlist if os.path.dirname(fpath) != set_dir)
+    outcomes = {}
+    try:
+        backend.run(fpathlist, outcomes)
+    finally:
+        if outcomes:
+            with manifest.SetLock(set_dir):
+                records = manifest.SetManifest(set_dir)
+                backend.record(records, outcomes)
+                records.save()
+    return outcomes
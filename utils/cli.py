@@ -0,0 +1,210 @@
+'''
+Command line interface
+    $ python -m utils <command> ...
+numpy and the parser modules are imported only by the commands that need them,
+so that pure file operations start fast on busy login nodes
+'''
+
+import os, sys, argparse
+
+
+
+def parse_number(string):
+    '''"250" -> 250, "250.5" -> 250.5'''
+    try:
+        return int(string)
+    except ValueError:
+        return float(string)
+
+
+def parse_triple(string):
+    '''"0,0,1" -> (0, 0, 1)'''
+    return tuple(int(s) for s in string.split(','))
+
+
+def parse_configs(pairs):
+    '''["n=16", "mem-per-cpu=2000"] -> {'-n': '16', '--mem-per-cpu': '2000'}'''
+    configs = {}
+    for pair in pairs:
+        key, _, val = pair.partition('=')
+        key = key.lstrip('-')
+        configs[('-' if len(key) == 1 else '--') + key] = val
+    return configs
+
+
+
+def cmd_make(args):
+    from utils import experiment
+    scanner, ptype = {
+        'ecut':     (experiment.EcutScanFromTemplate, parse_number),
+        'kpoints':  (experiment.KpointsScanFromTemplate, parse_triple),
+        'saxis':    (experiment.SaxisScanFromTemplate, parse_triple),
+    }[args.scan]
+    registry = None
+    if args.registry is not None:
+        registry = experiment.ResultRegistry(args.registry)
+    tree, diff = scanner(args.template).make(
+        [ptype(p) for p in args.params], args.out_dir,
+        header=args.header, info=args.info,
+        overwrite=args.overwrite, merge=args.merge,
+        dry_run=args.dry_run, registry=registry)
+    for exp_name, (status, changed) in diff.items():
+        print('{:<10s}{}'.format(status, exp_name))
+
+
+def cmd_continue(args):
+    from utils import experiment
+    configs = parse_configs(args.batch)
+    for exp_dir in args.exp_dirs:
+        if args.relax:
+            experiment.ToolKit.continue_relaxation(
+                exp_dir, batch_update=configs, push_conv=args.push_conv)
+        else:
+            experiment.ToolKit.continue_general(exp_dir, batch_update=configs)
+
+
+def cmd_switch(args):
+    from utils import experiment, vasp, slurm
+    exp_dirs = sorted(os.path.join(args.set_dir, fn) for fn in os.listdir(args.set_dir)
+                      if os.path.isfile(os.path.join(args.set_dir, fn, 'INCAR')))
+    switches = [(vasp.VaspINCAR, 'INCAR',
+                 os.path.join(args.template, 'INCAR'), args.incar_keeps)]
+    if os.path.isfile(os.path.join(args.template, 'batch.sh')):
+        switches.append((slurm.SlurmBatchScript, 'batch.sh',
+                         os.path.join(args.template, 'batch.sh'),
+                         list(parse_configs(args.batch_keeps))))
+    for exp_dir in experiment.ToolKit.switch_template_set(
+            exp_dirs, switches, nworkers=args.nworkers):
+        print(exp_dir)
+
+
+def cmd_submit(args):
+    from utils import backend
+    if args.local is not None:
+        runner = backend.LocalBackend(args.local or None)
+    else:
+        runner = backend.SlurmBackend()
+    outcomes = backend.submit_set(args.set_dir, runner, force=args.force)
+    for fpath in sorted(outcomes):
+        print('{}\t{}'.format(outcomes[fpath], fpath))
+
+
+def cmd_watch(args):
+    from utils import tracker, manifest
+    def report(status, exp_dir):
+        print('{:<10s}{}'.format(status, os.path.basename(exp_dir)))
+        sys.stdout.flush()
+        if args.record:
+            with manifest.SetLock(args.set_dir):
+                records = manifest.SetManifest(args.set_dir)
+                records.update(os.path.basename(exp_dir), status=status)
+                records.save()
+    inotify = {'auto': None, 'on': True, 'off': False}[args.inotify]
+    tracker.CompletionTracker(args.set_dir, callback=report, interval=args.interval,
+                              inotify=inotify).run(timeout=args.timeout)
+
+
+def cmd_analyze(args):
+    from utils import experiment
+    experiment.TimingAnalyzer().analyze(args.set_dir, report=args.report)
+    with open(os.path.join(args.set_dir, args.report), 'r') as file:
+        sys.stdout.write(file.read())
+
+
+def cmd_status(args):
+    from utils import manifest
+    if args.refresh:
+        with manifest.SetLock(args.set_dir):
+            records = manifest.SetManifest(args.set_dir)
+            records.refresh()
+            records.save()
+    else:
+        records = manifest.SetManifest(args.set_dir)
+    if args.list is not None:
+        for exp_name in records.query(status=args.list or None):
+            print('{:<10s}{}'.format(records.records[exp_name].get('status'), exp_name))
+        return
+    counts = {}
+    for record in records.records.values():
+        status = record.get('status')
+        counts[status] = counts.get(status, 0) + 1
+    for status in sorted(counts, key=str):
+        print('{:<10s}{}'.format(str(status), counts[status]))
+
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m utils',
+        description='workflow automations for VASP running on Slurm systems')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    make = commands.add_parser('make', help='makes a parameter scan from templates')
+    make.add_argument('scan', choices=['ecut', 'kpoints', 'saxis'])
+    make.add_argument('template', help='the directory of the template files')
+    make.add_argument('out_dir', help='the root directory of the experiment set')
+    make.add_argument('params', nargs='+',
+                      help='the scan values, triples are given like 0,0,1')
+    make.add_argument('--header', default=None)
+    make.add_argument('--info', default=None)
+    make.add_argument('--overwrite', action='store_true')
+    make.add_argument('--merge', action='store_true')
+    make.add_argument('--dry-run', action='store_true')
+    make.add_argument('--registry', default=None,
+                      help='the directory of a ResultRegistry')
+    make.set_defaults(func=cmd_make)
+
+    cont = commands.add_parser('continue', help='continues experiments in-place')
+    cont.add_argument('exp_dirs', nargs='+')
+    cont.add_argument('--batch', nargs='*', default=[],
+                      help='batch file updates like n=16 t=0-00:15')
+    cont.add_argument('--relax', action='store_true')
+    cont.add_argument('--push-conv', action='store_true')
+    cont.set_defaults(func=cmd_continue)
+
+    switch = commands.add_parser('switch', help='switches the templates of a whole set')
+    switch.add_argument('set_dir')
+    switch.add_argument('template', help='the directory of the new INCAR and batch.sh')
+    switch.add_argument('--incar-keeps', nargs='*', default=[])
+    switch.add_argument('--batch-keeps', nargs='*', default=['job-name'],
+                        help='keys kept from the old batch.sh, without the dashes')
+    switch.add_argument('--nworkers', type=int, default=None)
+    switch.set_defaults(func=cmd_switch)
+
+    submit = commands.add_parser('submit', help='submits the pending experiments of a set')
+    submit.add_argument('set_dir')
+    submit.add_argument('--local', type=int, nargs='?', const=0, default=None,
+                        help='runs on this machine with the given number of cores')
+    submit.add_argument('--force', action='store_true',
+                        help='resubmits the experiments already submitted')
+    submit.set_defaults(func=cmd_submit)
+
+    watch = commands.add_parser('watch', help='reports the experiments of a set as they end')
+    watch.add_argument('set_dir')
+    watch.add_argument('--interval', type=float, default=30.,
+                       help='the seconds between the polling rounds')
+    watch.add_argument('--timeout', type=float, default=None)
+    watch.add_argument('--inotify', choices=['auto', 'on', 'off'], default='auto')
+    watch.add_argument('--record', action='store_true',
+                       help='records the outcome in the manifest')
+    watch.set_defaults(func=cmd_watch)
+
+    analyze = commands.add_parser('analyze', help='reports the timing of a set')
+    analyze.add_argument('set_dir')
+    analyze.add_argument('--report', default='timing.txt')
+    analyze.set_defaults(func=cmd_analyze)
+
+    status = commands.add_parser('status', help='summarizes the manifest of a set')
+    status.add_argument('set_dir')
+    status.add_argument('--refresh', action='store_true')
+    status.add_argument('--list', nargs='?', const='', default=None,
+                        help='lists the experiments, optionally of one status')
+    status.set_defaults(func=cmd_status)
+    return parser
+
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+    return 0
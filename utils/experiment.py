@@ -4,8 +4,12 @@ Author: Yiqi Xie
 Date:   May 9, 2018
 '''
 
-import os, sys, shutil
+import os, sys, shutil, math
+import collections, filecmp, tempfile
+import hashlib, copy, fnmatch
 from utils import vasp, slurm, structure
+from utils.manifest import SetManifest, SetLock
+import concurrent.futures
 
 
 #################### General Methods ####################
@@ -73,29 +77,92 @@ class ToolKit:
 
     @classmethod
     def make_out_dir(cls, out_dir, overwrite=False, merge=False):
-        '''makes the output directory'''
-        if not os.path.exists(out_dir):
-            os.mkdir(out_dir)
-        elif overwrite:
-            shutil.rmtree(out_dir)
-            os.mkdir(out_dir)
-        elif not merge:
-            raise ValueError(
-                'output directory \"{}\" '\
-                    +'already exists.'.format(out_dir))
+        '''makes the output directory, safe against other processes 
+            doing the same at the same time'''
+        with SetLock(out_dir):
+            if not os.path.exists(out_dir):
+                os.mkdir(out_dir)
+            elif overwrite:
+                shutil.rmtree(out_dir)
+                os.mkdir(out_dir)
+            elif not merge:
+                raise ValueError(
+                    'output directory \"{}\" already exists.'.format(out_dir))
 
     @classmethod
-    def copy_all(cls, src_dir, dest_dir):
-        '''copies all files and subdirectories from one root to another'''
+    def copy_all(cls, src_dir, dest_dir, policy={}):
+        '''copies all files and subdirectories from one root to another,
+            policy maps file names (or glob patterns) to the copy modes 
+            accepted by copy_file()'''
         if not os.path.exists(dest_dir):
             os.mkdir(dest_dir)
         for fname in os.listdir(src_dir):
             fpath_old = os.path.join(src_dir, fname)
             fpath_new = os.path.join(dest_dir, fname)
-            if os.path.isdir(fname):
+            if os.path.isdir(fpath_old):
                 shutil.copytree(fpath_old, fpath_new)
             else:
-                shutil.copy2(fpath_old, fpath_new)
+                cls.copy_file(fpath_old, fpath_new, cls.copy_mode(fname, policy))
+
+    @classmethod
+    def copy_mode(cls, fname, policy):
+        '''looks up the copy mode of a file, defaults to 'copy' '''
+        if fname in policy:
+            return policy[fname]
+        for pattern, mode in policy.items():
+            if fnmatch.fnmatch(fname, pattern):
+                return mode
+        return 'copy'
+
+    @classmethod
+    def copy_file(cls, src, dest, mode='copy'):
+        '''copies a file in one of the modes:
+                copy:       a plain copy
+                skip:       does nothing
+                reflink:    a copy-on-write clone, falls back to copy
+                hardlink:   a hard link, falls back to copy
+                symlink:    a symbolic link to the absolute source path
+                link:       tries reflink, then hardlink, then copy
+            note that a hard or symbolic link shares the data with the source,
+            use them only for the files that VASP provably never opens for writing,
+            VASP may truncate WAVECAR and CHGCAR even with LWAVE and LCHARG off,
+            so restart files should rather be reflinked'''
+        if mode == 'skip':
+            return
+        if mode == 'symlink':
+            os.symlink(os.path.abspath(src), dest)
+            return
+        if mode in ('reflink', 'link'):
+            try:
+                cls.reflink(src, dest)
+                return
+            except OSError:
+                pass
+        if mode in ('hardlink', 'link'):
+            try:
+                os.link(src, dest)
+                return
+            except OSError:
+                pass
+        shutil.copy2(src, dest)
+
+    @classmethod
+    def reflink(cls, src, dest):
+        '''clones a file through the FICLONE ioctl (btrfs, xfs, ...),
+            raises OSError where not supported'''
+        try:
+            import fcntl
+        except ImportError:
+            raise OSError('reflink is not supported on this platform')
+        FICLONE = 0x40049409
+        try:
+            with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+                fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+        except (OSError, IOError):
+            if os.path.exists(dest):
+                os.remove(dest)
+            raise OSError('reflink failed from \"{}\"'.format(src))
+        shutil.copystat(src, dest)
 
     @classmethod
     def write_info(cls, out_dir, info=None):
@@ -107,13 +174,18 @@ class ToolKit:
                 file.write(info)
 
     @classmethod
-    def write_poscar_abs(cls, struc, header='POSCAR', outpath='./POSCAR'):
+    def make_poscar_abs(cls, struc, header='POSCAR'):
         '''the struc should resemble the ones defined in structure.py'''
-        carlines = vasp.VaspPOSCAR.create(
+        return vasp.VaspPOSCAR.create(
                         struc.symbols, struc.numbers, 
                         struc.cell, struc.cartesian,
                         scale=1.0, direct=False, 
                         header=header)
+
+    @classmethod
+    def write_poscar_abs(cls, struc, header='POSCAR', outpath='./POSCAR'):
+        '''the struc should resemble the ones defined in structure.py'''
+        carlines = cls.make_poscar_abs(struc, header)
         with open(outpath, 'w') as file:
             file.writelines(carlines)
         return carlines
@@ -123,23 +195,29 @@ class ToolKit:
         '''the struc should resemble the ones defined in structure.py'''
         carlines = vasp.VaspPOSCAR.create(
                         struc.symbols, struc.numbers, 
-                        struc.cell/self.a, struc.direct,
+                        struc.cell/struc.a, struc.direct,
                         scale=struc.a, direct=True, 
-                        header='header')
+                        header=header)
         with open(outpath, 'w') as file:
             file.writelines(carlines)
         return carlines
 
     @classmethod
-    def alter_file(cls, ftype, fpath, configs={}):
+    def alter_file(cls, ftype, fpath, configs={}, **kwargs):
         '''alters a file at fpath of ftype with configs,
-            the ftype should resemble the AlterableFile defined in template.py'''
+            the ftype should resemble the AlterableFile defined in template.py,
+            kwargs go to its alter(), e.g. append=True of a KVPFile'''
         frep = ftype.load(fpath)
-        flines = frep.alter(configs=configs)
+        flines = frep.alter(configs=configs, **kwargs)
         with open(fpath, 'w') as f:
             f.writelines(flines)
         return flines
 
+    @classmethod
+    def alter_lines(cls, ftype, flines, configs={}):
+        '''the same as alter_file, but works on the lines in memory'''
+        return ftype(flines).alter(configs=configs)
+
     @classmethod
     def switch_template(cls, ftype, fpath, tpath, keeps=[]):
         '''switches the template of the file at fpath using the file at tpath,
@@ -152,6 +230,36 @@ class ToolKit:
             f.writelines(flines)
         return flines
 
+    @classmethod
+    def switch_template_set(cls, exp_dirs, switches, nworkers=None):
+        '''switches the templates of many experiments in one pass,
+                exp_dirs:   the experiment directories
+                switches:   a list of (ftype, fname, tpath, keeps), 
+                            works like switch_template on <exp_dir>/<fname>
+                nworkers:   the number of threads, the work is mostly file I/O
+            each template is parsed only once, and only the values in keeps
+            are read from the experiments, the ftype should resemble 
+            the KVPFile defined in template.py'''
+        treps = [(ftype, fname, ftype.load(tpath), keeps) 
+                  for ftype, fname, tpath, keeps in switches]
+        def switch_one(exp_dir):
+            for ftype, fname, trep, keeps in treps:
+                fpath = os.path.join(exp_dir, fname)
+                flines = trep.alter(configs=ftype.peek(fpath, keeps))
+                tmppath = '{}.{}.tmp'.format(fpath, os.getpid())
+                with open(tmppath, 'w') as f:
+                    f.writelines(flines)
+                os.rename(tmppath, fpath)
+            return exp_dir
+        with concurrent.futures.ThreadPoolExecutor(nworkers) as pool:
+            return list(pool.map(switch_one, exp_dirs))
+
+    @classmethod
+    def switch_lines(cls, ftype, flines, tlines, keeps=[]):
+        '''the same as switch_template, but works on the lines in memory'''
+        frep = ftype(flines)
+        return ftype(tlines).alter(configs={k:frep.view(k) for k in keeps})
+
     @classmethod
     def continue_general(cls, exp_dir, 
                          batch_name='batch.sh', 
@@ -190,6 +298,375 @@ class ToolKit:
 
 
 
+class LinkedFile(str):
+    '''a path to a file that VirtualTree links instead of copying,
+        mode is one of those accepted by ToolKit.copy_file()'''
+
+    def __new__(cls, path, mode='reflink'):
+        obj = super(LinkedFile, cls).__new__(cls, path)
+        obj.mode = mode
+        return obj
+
+
+
+class VirtualTree:
+    '''an in-memory image of an experiment set, 
+        maps each experiment name to its files as {<file name>: <content>},
+        where the content is either a list of lines rendered in memory,
+        or a path to the file (or directory) to be copied from,
+        a path given as LinkedFile is linked according to its mode.
+        the set is written to the disk in bulk by commit(),
+        which also records the hash of each experiment in the SetManifest 
+        at the set root, so that a later merge can skip the unchanged 
+        experiments without reading them back from the disk'''
+
+    STAGING = '.staging_'
+    SMALL = 1 << 16     # the files up to this size are hashed by contents
+
+    def __init__(self):
+        self.exps = collections.OrderedDict()
+        self.params = {}
+        self.status = {}
+        self.origins = {}
+        self.keys = {}
+
+    def add(self, exp_name, src_dir, policy={}, params={}):
+        '''adds an experiment that refers to all files in src_dir,
+            policy works as in ToolKit.copy_all(),
+            params are the scan parameters recorded in the manifest'''
+        self.params[exp_name] = dict(params)
+        files = collections.OrderedDict()
+        for fname in sorted(os.listdir(src_dir)):
+            fpath = os.path.join(src_dir, fname)
+            mode = ToolKit.copy_mode(fname, policy)
+            if mode == 'copy' or os.path.isdir(fpath):
+                files[fname] = fpath
+            elif mode != 'skip':
+                files[fname] = LinkedFile(fpath, mode)
+        self.exps[exp_name] = files
+        return files
+
+    @staticmethod
+    def read(files, fname):
+        '''returns the lines of a file, loads it into memory if necessary'''
+        if not isinstance(files[fname], list):
+            with open(files[fname], 'r') as file:
+                files[fname] = file.readlines()
+        return files[fname]
+
+    @classmethod
+    def same(cls, content, fpath):
+        '''tells whether the content is identical to the file at fpath,
+            small files are compared by contents, larger ones by size and 
+            mtime first, as a same-size edit may keep the mtime (see stamp())'''
+        if not os.path.exists(fpath):
+            return False
+        if isinstance(content, list):
+            with open(fpath, 'r') as file:
+                return file.read() == ''.join(content)
+        if os.path.isdir(content):
+            return os.path.isdir(fpath)
+        if os.path.getsize(content) <= cls.SMALL and os.path.isfile(fpath):
+            # filecmp caches its outcomes by size and mtime, so read directly
+            with open(content, 'rb') as f1, open(fpath, 'rb') as f2:
+                return f1.read() == f2.read()
+        return filecmp.cmp(content, fpath, shallow=True)
+
+    @classmethod
+    def digest(cls, files):
+        '''hashes the contents of an experiment,
+            a file to be copied is represented as in stamp()'''
+        sha = hashlib.sha1()
+        for fname in sorted(files):
+            content = files[fname]
+            sha.update(fname.encode('utf-8'))
+            if isinstance(content, list):
+                sha.update(''.join(content).encode('utf-8'))
+            elif os.path.isdir(content):
+                sha.update(b'<dir>')
+            else:
+                sha.update(cls.stamp(content))
+        return sha.hexdigest()
+
+    @classmethod
+    def stamp(cls, fpath):
+        '''the contents of a small file (e.g. INCAR, KPOINTS), otherwise
+            its size and mtime in ns, the contents are read as a same-size 
+            edit within one second may keep the mtime on coarse file systems'''
+        stat = os.stat(fpath)
+        if stat.st_size <= cls.SMALL:
+            with open(fpath, 'rb') as file:
+                return file.read()
+        return '{}:{}'.format(stat.st_size, stat.st_mtime_ns).encode('utf-8')
+
+    def diff(self, out_dir, records=None):
+        '''compares the tree with what is on the disk,
+            returns {<experiment name>: (<status>, <changed file names>)}
+            where the status is one of 'new', 'changed', 'unchanged'.
+            an experiment whose hash matches the manifest is unchanged,
+            otherwise its files are compared one by one,
+            records are the manifest records of out_dir, read anew if None'''
+        result = collections.OrderedDict()
+        manifest = SetManifest(out_dir).records if records is None else records
+        for exp_name, files in self.exps.items():
+            exp_dir = os.path.join(out_dir, exp_name)
+            if not os.path.isdir(exp_dir):
+                result[exp_name] = ('new', list(files))
+                continue
+            record = manifest.get(exp_name, {})
+            if record.get('hash') == self.digest(files):
+                result[exp_name] = ('unchanged', [])
+                continue
+            changed = [fname for fname, content in files.items() 
+                       if not self.same(content, os.path.join(exp_dir, fname))]
+            result[exp_name] = ('changed' if changed else 'unchanged', changed)
+        return result
+
+    def commit(self, out_dir, diff=None, info=None, 
+               overwrite=False, merge=False, records=None):
+        '''writes the tree to out_dir in bulk,
+            a new (or overwritten) set is built in a staging directory 
+            and then renamed into place, 
+            a merge builds each new experiment in a staging directory
+            and replaces the changed files one by one atomically,
+            the files that are not in the tree are left untouched.
+            the set root, info.txt and the manifest are only touched 
+            under a SetLock, so that many processes can merge into one set.
+            records given, a merge updates them in place instead of the manifest,
+            and leaves the manifest and info.txt for the caller to save in bulk'''
+        if diff is None:
+            diff = self.diff(out_dir, records)
+        if overwrite or not os.path.exists(out_dir):
+            staging = self.build(out_dir, info)
+            with SetLock(out_dir):
+                if overwrite or not os.path.exists(out_dir):
+                    self.swap(staging, out_dir)
+                    return
+            # another process has made the set in the meantime
+            shutil.rmtree(staging)
+            diff = self.diff(out_dir)
+        if not merge:
+            raise ValueError(
+                'output directory \"{}\" already exists.'.format(out_dir))
+        pending = [(exp_name, status, changed) 
+                   for exp_name, (status, changed) in diff.items()
+                   if status != 'unchanged']
+        if pending:
+            staging = tempfile.mkdtemp(prefix=self.STAGING, dir=out_dir)
+            try:
+                for exp_name, status, changed in pending:
+                    self.merge_exp(exp_name, status, changed, 
+                                   out_dir, staging)
+            finally:
+                shutil.rmtree(staging)
+        if records is not None:
+            self.update_manifest(records, diff)
+            return
+        with SetLock(out_dir):
+            ToolKit.write_info(out_dir, info)
+            manifest = SetManifest(out_dir)
+            records = copy.deepcopy(manifest.records)
+            if self.update_manifest(manifest.records, diff) != records:
+                manifest.save()
+
+    def build(self, out_dir, info=None):
+        '''writes the whole tree into a new staging directory beside out_dir'''
+        parent = os.path.dirname(os.path.abspath(out_dir))
+        staging = tempfile.mkdtemp(prefix=self.STAGING, dir=parent)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(staging, 0o777 & ~umask)
+        for exp_name, files in self.exps.items():
+            self.materialize(files, os.path.join(staging, exp_name))
+        ToolKit.write_info(staging, info)
+        manifest = SetManifest(staging)
+        self.update_manifest(manifest.records)
+        manifest.save()
+        return staging
+
+    def merge_exp(self, exp_name, status, changed, out_dir, staging):
+        '''writes a new experiment or the changed files of an old one'''
+        exp_dir = os.path.join(out_dir, exp_name)
+        files = self.exps[exp_name]
+        if status == 'new':
+            self.materialize(files, os.path.join(staging, exp_name))
+            os.rename(os.path.join(staging, exp_name), exp_dir)
+        else:
+            for fname in changed:
+                self.replace(files[fname], os.path.join(exp_dir, fname), staging)
+
+    def update_manifest(self, records, diff=None):
+        '''records the hash and the parameters of every experiment in the tree,
+            an experiment that is new, or has changed files according to diff
+            (None when the whole set is written anew), is reset to the 'created' 
+            status, unless it reuses the results found by ResultRegistry,
+            a hash mismatch alone (e.g. a touched template) only renews the hash'''
+        for exp_name, files in self.exps.items():
+            fresh = exp_name not in records or diff is None or \
+                    diff.get(exp_name, ('new', []))[0] != 'unchanged'
+            record = records.setdefault(exp_name, {})
+            record['hash'] = self.digest(files)
+            if fresh:
+                record.update(jobid=None, submitted=None,
+                              status=self.status.get(exp_name, 'created'))
+                record['key'] = self.keys.get(exp_name) or ResultRegistry.key(files)
+                if exp_name in self.origins:
+                    record['origin'] = self.origins[exp_name]
+            record['params'] = SetManifest.jsonify(self.params[exp_name])
+        return records
+
+    @classmethod
+    def materialize(cls, files, exp_dir):
+        '''writes all files of an experiment into exp_dir'''
+        os.mkdir(exp_dir)
+        for fname, content in files.items():
+            cls.write(content, os.path.join(exp_dir, fname))
+
+    @staticmethod
+    def write(content, fpath):
+        if isinstance(content, list):
+            with open(fpath, 'w') as file:
+                file.writelines(content)
+        elif isinstance(content, LinkedFile):
+            ToolKit.copy_file(content, fpath, content.mode)
+        elif os.path.isdir(content):
+            shutil.copytree(content, fpath)
+        else:
+            shutil.copy2(content, fpath)
+
+    @classmethod
+    def replace(cls, content, fpath, staging):
+        '''writes a file into the staging directory, then renames it to fpath'''
+        tmppath = os.path.join(staging, os.path.basename(fpath))
+        cls.write(content, tmppath)
+        if os.path.isdir(fpath):
+            shutil.rmtree(fpath)
+        os.rename(tmppath, fpath)
+
+    @staticmethod
+    def swap(staging, out_dir):
+        '''renames staging to out_dir, the old out_dir is removed only 
+            after the new one is in place'''
+        if os.path.exists(out_dir):
+            backup = staging + '.old'
+            os.rename(out_dir, backup)
+            os.rename(staging, out_dir)
+            shutil.rmtree(backup)
+        else:
+            os.rename(staging, out_dir)
+
+
+
+
+
+class ResultRegistry:
+    '''a content-addressed registry of finished experiments across sets,
+        maps the hash of the VASP inputs to the experiment directory,
+        each entry is kept as a small file <root>/<hash[:2]>/<hash>
+
+        the key covers the full contents of INPUTS, and the size and mtime 
+        of RESTARTS, since a non-self-consistent run depends on them as well.
+        as VASP leaves RESTARTS behind after every run, the key of a finished
+        experiment is the one recorded in the SetManifest when it was created'''
+
+    INPUTS = ['INCAR', 'KPOINTS', 'POSCAR', 'POTCAR']
+    RESTARTS = ['CHGCAR', 'WAVECAR']
+
+    def __init__(self, root, mode='reflink'):
+        ''' root:   the directory of the registry
+            mode:   how the results are brought to a new experiment,
+                    see ToolKit.copy_file(), the default never shares data'''
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.root = root
+        self.mode = mode
+
+    @classmethod
+    def key(cls, files, restarts=True):
+        '''hashes an experiment given as {<file name>: <lines or path>}'''
+        sha = hashlib.sha1()
+        for fname in cls.INPUTS + (cls.RESTARTS if restarts else []):
+            if fname not in files:
+                continue
+            content = files[fname]
+            sha.update(fname.encode('utf-8'))
+            if isinstance(content, list):
+                sha.update(''.join(content).encode('utf-8'))
+            elif fname in cls.INPUTS:
+                with open(content, 'rb') as file:
+                    sha.update(file.read())
+            else:
+                sha.update(VirtualTree.stamp(content))
+        return sha.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def register_exp(self, exp_dir, key=None):
+        '''registers a finished experiment, returns its key,
+            the key defaults to the one in the SetManifest of its set,
+            for the sets made without it, the key is taken from INPUTS alone,
+            since the RESTARTS on the disk may well be outputs of the run'''
+        exp_dir = os.path.abspath(exp_dir)
+        if key is None:
+            set_dir, exp_name = os.path.split(exp_dir)
+            key = SetManifest(set_dir).records.get(exp_name, {}).get('key')
+        if key is None:
+            files = {fname: os.path.join(exp_dir, fname) for fname in os.listdir(exp_dir)}
+            key = self.key(files, restarts=False)
+        fpath = self._entry(key)
+        if not os.path.isdir(os.path.dirname(fpath)):
+            os.makedirs(os.path.dirname(fpath))
+        tmppath = '{}.{}.tmp'.format(fpath, os.getpid())
+        with open(tmppath, 'w') as file:
+            file.write(exp_dir)
+        os.rename(tmppath, fpath)
+        return key
+
+    def register(self, set_dir):
+        '''registers all completed experiments in the SetManifest of a set'''
+        manifest = SetManifest(set_dir)
+        return [self.register_exp(os.path.join(set_dir, exp_name), 
+                                  manifest.records[exp_name].get('key'))
+                for exp_name in manifest.query(status='completed')]
+
+    def lookup(self, key):
+        '''returns the directory of a finished experiment, None if missing'''
+        fpath = self._entry(key)
+        if not os.path.isfile(fpath):
+            return None
+        with open(fpath, 'r') as file:
+            exp_dir = file.read().strip()
+        if not os.path.isfile(os.path.join(exp_dir, 'OUTCAR')):
+            return None
+        return exp_dir
+
+    def reuse(self, tree, out_dir, keeps=()):
+        '''replaces each experiment of the tree that is not yet in out_dir 
+            and has a finished counterpart by the files of the latter, 
+            except the files in keeps, and marks it as completed
+            returns {<experiment name>: <reused directory>}'''
+        hits = {}
+        for exp_name, files in tree.exps.items():
+            if os.path.isdir(os.path.join(out_dir, exp_name)):
+                continue
+            key = self.key(files)
+            exp_dir = self.lookup(key)
+            if exp_dir is None:
+                continue
+            tree.keys[exp_name] = key
+            for fname in sorted(os.listdir(exp_dir)):
+                if fname not in keeps:
+                    files[fname] = LinkedFile(os.path.join(exp_dir, fname), self.mode)
+            tree.status[exp_name] = 'completed'
+            tree.origins[exp_name] = exp_dir
+            hits[exp_name] = exp_dir
+        return hits
+
+
+
+
+
 #################### Parameter Scan ####################
 
 class ScanFromTemplate(ExperimentSetMaker):
@@ -197,6 +674,7 @@ class ScanFromTemplate(ExperimentSetMaker):
 
     BATCHFILE = 'batch.sh'
     VASPINPUTS = ['INCAR', 'KPOINTS', 'POTCAR', 'POSCAR']
+    PARAM = 'param'     # the parameter name recorded in the manifest
 
     def __init__(self, src_dir):
         '''src_dir contains the template files'''
@@ -205,44 +683,61 @@ class ScanFromTemplate(ExperimentSetMaker):
 
     def make(self, param_list, out_dir, 
              header=None, info=None, 
-             overwrite=False, merge=False):
+             overwrite=False, merge=False, dry_run=False, 
+             registry=None):
         ''' param_list: the target to scan with
             out_dir:    the root directory where the experiment set is organized
             header:     a clue str that appears in all experiment namings
             info:       an info str that would be written as '<out_dir>/info.txt'
-            overwrite, merge:   the mode to make the out_dir'''
-        ToolKit.make_out_dir(out_dir, overwrite, merge)
-        ToolKit.write_info(out_dir, info)
+            overwrite, merge:   the mode to make the out_dir
+            dry_run:    if true, nothing would be written
+            registry:   a ResultRegistry, the experiments found in it 
+                        reuse the finished results instead of running again
+            returns the VirtualTree of the set and its diff against out_dir'''
+        tree = self.plan(param_list, header)
+        if registry is not None:
+            registry.reuse(tree, out_dir, keeps=[self.BATCHFILE])
+        diff = tree.diff(out_dir)
+        if not dry_run:
+            tree.commit(out_dir, diff, info, overwrite, merge)
+        return tree, diff
+
+    def plan(self, param_list, header=None):
+        '''renders the whole experiment set in memory'''
+        tree = VirtualTree()
         for p in param_list:
-            exp_name, exp_dir = self._init_exp(out_dir, header, p)
-            self._alter_vaspin(exp_dir, exp_name, p)
-            self._alter_batch(exp_dir, exp_name, p)
+            exp_name, files = self._init_exp(tree, header, p)
+            self._alter_vaspin(files, exp_name, p)
+            self._alter_batch(files, exp_name, p)
+        return tree
 
     def _make_exp_name(self, header, p):
         '''the naming convention of each experiment'''
         raise NotImplementedError
 
-    def _alter_vaspin(self, exp_dir, exp_name, p):
-        '''the method to alter the vasp input files from given templates'''
+    def _alter_vaspin(self, files, exp_name, p):
+        '''the method to alter the vasp input files from given templates,
+            files is the in-memory experiment given by VirtualTree.add()'''
         raise NotImplementedError
 
-    def _alter_batch(self, exp_dir, exp_name, p):
+    def _alter_batch(self, files, exp_name, p):
         '''the method to alter the batch file from given template'''
-        ToolKit.alter_file(
+        files[self.BATCHFILE] = ToolKit.alter_lines(
             slurm.SlurmBatchScript, 
-            os.path.join(exp_dir, self.BATCHFILE), 
+            VirtualTree.read(files, self.BATCHFILE), 
             configs={'--job-name':exp_name})
 
-    def _init_exp(self, out_dir, header, p):
+    def _init_exp(self, tree, header, p):
         exp_name = self._make_exp_name(header, p)
-        exp_dir = os.path.join(out_dir, exp_name)
-        ToolKit.copy_all(self.src_dir, exp_dir)
-        return exp_name, exp_dir
+        files = tree.add(exp_name, self.src_dir, params={self.PARAM: p})
+        return exp_name, files
 
 
 
 class StrucScanFromTemplate(ScanFromTemplate):
 
+    PARAM = 'alat'
+
     def __init__(self, src_dir, struc_gen):
         '''struc_gen should resemble:
                 lambda p: struc(p, *<other_args>)
@@ -254,57 +749,61 @@ class StrucScanFromTemplate(ScanFromTemplate):
     def _make_exp_name(self, header, p):
         return '{}_alat={:0.3e}'.format(header, p)
 
-    def _alter_vaspin(self, exp_dir, exp_name, p):
-        ToolKit.write_poscar_abs(
-            struc=self.struc_gen(p), 
-            outpath=os.path.join(exp_dir, 'POSCAR'))
+    def _alter_vaspin(self, files, exp_name, p):
+        files['POSCAR'] = ToolKit.make_poscar_abs(struc=self.struc_gen(p))
 
 
 
 class EcutScanFromTemplate(ScanFromTemplate):
 
+    PARAM = 'ecut'
+
     def __init__(self, src_dir):
         super(EcutScanFromTemplate, self).__init__(src_dir)
 
     def _make_exp_name(self, header, p):
         return '{}_ecut={}'.format(header, p)
 
-    def _alter_vaspin(self, exp_dir, exp_name, p):
-        ToolKit.alter_file(
+    def _alter_vaspin(self, files, exp_name, p):
+        files['INCAR'] = ToolKit.alter_lines(
             vasp.VaspINCAR, 
-            os.path.join(exp_dir, 'INCAR'), 
+            VirtualTree.read(files, 'INCAR'), 
             configs={'ENCUT': str(p)})
 
 
 
 class KpointsScanFromTemplate(ScanFromTemplate):
 
+    PARAM = 'kgrid'
+
     def __init__(self, src_dir):
         super(KpointsScanFromTemplate, self).__init__(src_dir)
 
     def _make_exp_name(self, header, p):
         return '{}_kgrid=[{}_{}_{}]'.format(header, *p)
 
-    def _alter_vaspin(self, exp_dir, exp_name, p):
-        ToolKit.alter_file(
+    def _alter_vaspin(self, files, exp_name, p):
+        files['KPOINTS'] = ToolKit.alter_lines(
             vasp.VaspKPOINTS, 
-            os.path.join(exp_dir, 'KPOINTS'), 
+            VirtualTree.read(files, 'KPOINTS'), 
             configs={'grid': p})
 
 
 
 class SaxisScanFromTemplate(ScanFromTemplate):
 
+    PARAM = 'saxis'
+
     def __init__(self, src_dir):
         super(SaxisScanFromTemplate, self).__init__(src_dir)
 
     def _make_exp_name(self, header, p):
         return '{}_saxis=[{}_{}_{}]'.format(header, *p)
 
-    def _alter_vaspin(self, exp_dir, exp_name, p):
-        ToolKit.alter_file(
+    def _alter_vaspin(self, files, exp_name, p):
+        files['INCAR'] = ToolKit.alter_lines(
             vasp.VaspINCAR, 
-            os.path.join(exp_dir, 'INCAR'), 
+            VirtualTree.read(files, 'INCAR'), 
             configs={'SAXIS': '{} {} {}'.format(*p)})
 
 
@@ -316,61 +815,424 @@ class SaxisScanFromTemplate(ScanFromTemplate):
 class NewScanFromOld(ScanFromTemplate):
     '''perform new scan based on old experiment results'''
 
-    def __init__(self, new_dir, src_dir):
+    # outputs that the new experiments do not need are skipped,
+    # restart files are cloned where the file system supports it, else copied,
+    # never hard linked, as VASP may rewrite them and spoil the old set
+    COPY_POLICY = {
+        'WAVECAR': 'reflink', 'CHGCAR': 'reflink',
+        'CHG': 'skip', 'OUTCAR': 'skip', 'OSZICAR': 'skip', 
+        'PROCAR': 'skip', 'DOSCAR': 'skip', 'EIGENVAL': 'skip', 
+        'XDATCAR': 'skip', 'PCDAT': 'skip', 'REPORT': 'skip', 
+        'IBZKPT': 'skip', 'vasprun.xml': 'skip', 'vaspout.h5': 'skip', 
+        'LOCPOT': 'skip', 'ELFCAR': 'skip', 'AECCAR*': 'skip', 
+        'PARCHG*': 'skip', 'WAVEDER': 'skip', 'vasp.out': 'skip', 
+        'job_*.out': 'skip', 'job_*.err': 'skip', 'job_*.run': 'skip',
+    }
+
+    def __init__(self, new_dir, src_dir, copy_policy=None, params=None):
         '''src_dir contains the old experiment results
-            new_dir contains the new scanner template'''
+            new_dir contains the new scanner template
+            copy_policy works as in ToolKit.copy_all(), 
+                        defaults to COPY_POLICY, {} copies everything
+            params      the scan parameters of the old experiment,
+                        read from the manifest of the old set if None'''
         super(NewScanFromOld, self).__init__(src_dir)
         assert(os.path.isdir(new_dir))
         self.new_dir = new_dir
+        if copy_policy is None:
+            copy_policy = self.COPY_POLICY
+        self.copy_policy = copy_policy
+        if params is None:
+            src_dir = os.path.normpath(src_dir)
+            params = SetManifest(os.path.dirname(src_dir)).params(
+                        os.path.basename(src_dir))
+        self.params = params
 
     def make(self, param_list, out_dir, 
              incar_keeps=[], batch_keeps=[], 
              header=None, info=None, 
-             overwrite=False, merge=False):
+             overwrite=False, merge=False, dry_run=False, 
+             registry=None, records=None):
         '''much the same as in ScanFromTemplate,
-            deploys ToolKit.continue_general to update POSCAR
-            deploys ToolKit.switch_template to reconfigure batch file and INCAR
-                incar_keeps, batch_keeps:   the input for ToolKit.switch_template()'''
-        ToolKit.make_out_dir(out_dir, overwrite, merge)
-        ToolKit.write_info(out_dir, info)
+            does the CONTCAR-POSCAR trick as in ToolKit.continue_general
+            deploys ToolKit.switch_lines to reconfigure batch file and INCAR
+                incar_keeps, batch_keeps:   the input for ToolKit.switch_lines()
+                records:    the manifest records of out_dir, if already read,
+                            a merge then updates them instead of the manifest
+                            (see VirtualTree.commit)'''
+        tree = self.plan(param_list, incar_keeps, batch_keeps, header)
+        if registry is not None:
+            registry.reuse(tree, out_dir, keeps=[self.BATCHFILE])
+        diff = tree.diff(out_dir, records)
+        if not dry_run:
+            tree.commit(out_dir, diff, info, overwrite, merge, records)
+        return tree, diff
+
+    def plan(self, param_list, incar_keeps=[], batch_keeps=[], header=None):
+        tree = VirtualTree()
+        templates = {}
         for p in param_list:
-            exp_name, exp_dir = self._init_exp(out_dir, header, p)
-            if 'CONTCAR' in os.listdir(exp_dir):
-                ToolKit.continue_general(exp_dir)
-            self._switch_templates(exp_dir, incar_keeps, batch_keeps)
-            self._alter_vaspin(exp_dir, exp_name, p)
-            self._alter_batch(exp_dir, exp_name, p)
+            exp_name, files = self._init_exp(tree, header, p)
+            if 'CONTCAR' in files:
+                files['POSCAR_old'] = files['POSCAR']
+                files['POSCAR'] = files['CONTCAR']
+            self._switch_templates(files, templates, incar_keeps, batch_keeps)
+            self._alter_vaspin(files, exp_name, p)
+            self._alter_batch(files, exp_name, p)
+        return tree
+
+    @classmethod
+    def expand_set(cls, new_dir, oldset_dir, newset_dir, param_list, 
+                   nworkers=None, copy_policy=None, **kwargs):
+        '''develops the same new scan on every experiment of an old set,
+            the experiments are handled by parallel processes that all merge 
+            into newset_dir, the other files at the old set root are copied.
+            both manifests are read once here, each process gets only its 
+            own records, and the new manifest is saved once at the end
+                nworkers:   the number of processes, defaults to the number of cores
+                kwargs:     passed to make(), e.g. incar_keeps
+            returns {<old experiment name>: <diff of its expansion>}'''
+        ToolKit.make_out_dir(newset_dir, merge=True)
+        old_manifest = SetManifest(oldset_dir)
+        new_records = SetManifest(newset_dir).records
+        old_names = []
+        for old_name in sorted(os.listdir(oldset_dir)):
+            old_path = os.path.join(oldset_dir, old_name)
+            if os.path.isdir(old_path):
+                old_names.append(old_name)
+            elif old_name != SetManifest.FNAME and not old_name.startswith('.'):
+                shutil.copy2(old_path, os.path.join(newset_dir, old_name))
+        with concurrent.futures.ProcessPoolExecutor(nworkers) as pool:
+            # the new experiments are named after the old ones, <old name>_...
+            futures = [(old_name, pool.submit(
+                            _expand_one, cls, new_dir, 
+                            os.path.join(oldset_dir, old_name), newset_dir, 
+                            param_list, old_name, copy_policy, 
+                            old_manifest.params(old_name),
+                            {k: v for k, v in new_records.items() 
+                             if k.startswith(old_name + '_')}, 
+                            kwargs))
+                       for old_name in old_names]
+            diffs, updates, error = collections.OrderedDict(), {}, None
+            for old_name, f in futures:
+                try:
+                    diffs[old_name], records = f.result()
+                    updates.update(records)
+                except Exception as e:
+                    error = error or e
+        # the merged experiments are recorded even if some others failed
+        if not kwargs.get('dry_run', False):
+            with SetLock(newset_dir):
+                ToolKit.write_info(newset_dir, kwargs.get('info'))
+                manifest = SetManifest(newset_dir)
+                manifest.records.update(updates)
+                manifest.save()
+        if error is not None:
+            raise error
+        return diffs
 
     def _make_exp_name(self, header, p):
         raise NotImplementedError
 
-    def _alter_vaspin(self, exp_dir, exp_name, p):
+    def _alter_vaspin(self, files, exp_name, p):
         raise NotImplementedError
 
-    def _switch_templates(self, exp_dir, incar_keeps, batch_keeps):
-        ToolKit.switch_template(
-            vasp.VaspINCAR, 
-            os.path.join(exp_dir, 'INCAR'),
-            os.path.join(self.new_dir, 'INCAR'),
-            incar_keeps)
-        ToolKit.switch_template(
-            slurm.SlurmBatchScript,
-            os.path.join(exp_dir, self.BATCHFILE),
-            os.path.join(self.new_dir, self.BATCHFILE),
-            batch_keeps)
+    def _init_exp(self, tree, header, p):
+        '''the new experiment inherits the parameters of the old one'''
+        exp_name = self._make_exp_name(header, p)
+        params = dict(self.params, **{self.PARAM: p})
+        files = tree.add(exp_name, self.src_dir, self.copy_policy, params)
+        return exp_name, files
+
+    def _switch_templates(self, files, templates, incar_keeps, batch_keeps):
+        '''templates caches the lines of the new templates'''
+        for fname, ftype, keeps in [
+                ('INCAR', vasp.VaspINCAR, incar_keeps),
+                (self.BATCHFILE, slurm.SlurmBatchScript, batch_keeps)]:
+            if fname not in templates:
+                with open(os.path.join(self.new_dir, fname), 'r') as file:
+                    templates[fname] = file.readlines()
+            files[fname] = ToolKit.switch_lines(
+                ftype, VirtualTree.read(files, fname), 
+                templates[fname], keeps)
 
 
 class SaxisScanFromSTD(NewScanFromOld):
 
-    def __init__(self, new_dir, src_dir):
-        super(SaxisScanFromSTD, self).__init__(new_dir, src_dir)
+    PARAM = 'saxis'
+
+    def __init__(self, new_dir, src_dir, copy_policy=None, params=None):
+        super(SaxisScanFromSTD, self).__init__(new_dir, src_dir, copy_policy, params)
 
     def _make_exp_name(self, header, p):
         return '{}_saxis=[{}_{}_{}]'.format(header, *p)
 
-    def _alter_vaspin(self, exp_dir, exp_name, p):
+    def _alter_vaspin(self, files, exp_name, p):
+        files['INCAR'] = ToolKit.alter_lines(
+            vasp.VaspINCAR, 
+            VirtualTree.read(files, 'INCAR'), 
+            configs={'SAXIS': '{} {} {}'.format(*p)})
+
+
+
+
+
+def _expand_one(scan_cls, new_dir, src_dir, out_dir, 
+                param_list, header, copy_policy, params, records, kwargs):
+    '''the task of each process in NewScanFromOld.expand_set(),
+        returns the diff and the updated manifest records'''
+    scanner = scan_cls(new_dir=new_dir, src_dir=src_dir, 
+                       copy_policy=copy_policy, params=params)
+    tree, diff = scanner.make(param_list, out_dir, header=header, 
+                              merge=True, records=records, **kwargs)
+    return diff, records
+
+
+
+
+
+#################### Result Analysis ####################
+
+class TimingAnalyzer(ExperimentSetAnalyzer):
+    '''collects the timing and memory usage of each experiment in a set,
+        helps to find the scan points and parallel settings 
+        that waste the allocation'''
+
+    OUTCAR = 'OUTCAR'
+    COLUMNS = ['ncores', 'kpar', 'npar', 'nscf', 'nionic',
+               'elapsed', 'cputime', 'maxmem', 
+               'corehours', 'sec_per_scf']
+
+    def analyze(self, set_dir, report='timing.txt'):
+        ''' set_dir:    the root directory where the experiment set is organized
+            report:     the name of the report file written under set_dir,
+                        if None, no report would be written
+            returns a dict of {<experiment name>: {<column>: <value>}}'''
+        results = {}
+        for exp_name in sorted(os.listdir(set_dir)):
+            fpath = os.path.join(set_dir, exp_name, self.OUTCAR)
+            if os.path.isfile(fpath):
+                outcar = vasp.VaspOUTCAR.load(fpath, magnetic=False)
+                results[exp_name] = self.summarize(outcar)
+        if report is not None:
+            self.write_report(os.path.join(set_dir, report), results)
+        return results
+
+    @classmethod
+    def summarize(cls, outcar):
+        '''derives the core-hours and seconds per SCF iteration,
+            if the job did not finish, the elapsed time falls back to 
+            the sum of the ionic step (LOOP+) times'''
+        contents = outcar.contents
+        looptimes = contents['looptimes']
+        ionictimes = contents['ionictimes']
+        summary = {k: contents.get(k) for k in ['ncores', 'kpar', 'npar', 
+                                                  'cputime', 'maxmem']}
+        summary['nscf'] = len(looptimes)
+        summary['nionic'] = len(ionictimes)
+        summary['elapsed'] = contents.get('elapsed', float(ionictimes.sum()))
+        if summary['ncores'] is not None:
+            summary['corehours'] = summary['ncores'] * summary['elapsed'] / 3600.
+        else:
+            summary['corehours'] = None
+        if summary['nscf'] > 0:
+            summary['sec_per_scf'] = float(looptimes.mean())
+        else:
+            summary['sec_per_scf'] = None
+        return summary
+
+    @classmethod
+    def write_report(cls, fpath, results):
+        '''writes the results as a whitespace-aligned table'''
+        width = max([len(n) for n in results] + [len('experiment')])
+        lines = [' '.join(['{:<{w}s}'.format('experiment', w=width)] 
+                          + ['{:>12s}'.format(c) for c in cls.COLUMNS])]
+        for exp_name, summary in results.items():
+            row = ['{:<{w}s}'.format(exp_name, w=width)]
+            for c in cls.COLUMNS:
+                val = summary.get(c)
+                if val is None:
+                    row.append('{:>12s}'.format('-'))
+                elif isinstance(val, int):
+                    row.append('{:>12d}'.format(val))
+                else:
+                    row.append('{:>12.3f}'.format(val))
+            lines.append(' '.join(row))
+        with open(fpath, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        return lines
+
+
+
+class ResultHarvester(ExperimentSetAnalyzer):
+    '''appends the parsed OUTCARs of a set to a ResultStore (see store.py),
+        the experiment ID is <set name>/<experiment name>,
+        the scan parameters in the manifest are kept as param.<name>'''
+
+    OUTCAR = 'OUTCAR'
+
+    def __init__(self, history=False):
+        self.history = history
+
+    def analyze(self, set_dir, store, status='completed'):
+        ''' set_dir:    the root directory where the experiment set is organized
+            store:      the ResultStore to append to
+            status:     only harvests the experiments of this status in the manifest,
+                        if the set has no manifest, every OUTCAR is harvested
+            the experiments already in the store are skipped,
+            returns the harvested experiment IDs'''
+        set_dir = os.path.abspath(set_dir)
+        set_name = os.path.basename(set_dir)
+        manifest = SetManifest(set_dir)
+        if manifest.records:
+            exp_names = manifest.query(status=status)
+        else:
+            exp_names = sorted(os.listdir(set_dir))
+        done = set(store.ids())
+        records = {}
+        for exp_name in exp_names:
+            exp_id = '{}/{}'.format(set_name, exp_name)
+            fpath = os.path.join(set_dir, exp_name, self.OUTCAR)
+            if exp_id in done or not os.path.isfile(fpath):
+                continue
+            records[exp_id] = self.collect(fpath, manifest.params(exp_name))
+        if records:
+            store.append(records)
+        return list(records)
+
+    def collect(self, fpath, params={}):
+        outcar = vasp.VaspOUTCAR.load(fpath, magnetic=False, history=self.history)
+        record = dict(outcar.contents)
+        for k, v in params.items():
+            record['param.' + k] = v
+        return record
+
+
+
+
+
+#################### Parallel Tuning ####################
+
+class ParallelTuner:
+    '''learns the parallel settings from the timing data of completed runs,
+        and proposes KPAR, NPAR and the Slurm resources for new experiments
+
+        the cost of a run is measured as core-seconds per SCF iteration 
+        per irreducible k-point, the settings are characterized by 
+        the number of cores per k-point group and NPAR'''
+
+    SLURM_ALIASES = {'-n': '--ntasks', '-N': '--nodes', '-t': '--time'}
+
+    def __init__(self, cores_per_node=32, max_cores=64, 
+                 time_margin=2.0, default_group=8):
+        ''' cores_per_node: the number of cores on each node of the partition
+            max_cores:      the upper limit of -n
+            time_margin:    the factor multiplied to the predicted runtime
+            default_group:  the cores per k-point group when nothing was learned'''
+        self.cores_per_node = cores_per_node
+        self.max_cores = max_cores
+        self.time_margin = time_margin
+        self.default_group = default_group
+        self.samples = []
+
+    def learn(self, set_dir):
+        '''collects the samples from all finished experiments in a set,
+            that is, whose OUTCAR has the total elapsed time'''
+        for exp_name in sorted(os.listdir(set_dir)):
+            fpath = os.path.join(set_dir, exp_name, TimingAnalyzer.OUTCAR)
+            if not os.path.isfile(fpath):
+                continue
+            outcar = vasp.VaspOUTCAR.load(fpath, magnetic=False)
+            if outcar.contents.get('elapsed') is None:
+                continue
+            summary = TimingAnalyzer.summarize(outcar)
+            nk = outcar.contents.get('uniquekpoints')
+            if None in (nk, summary['ncores'], summary['kpar'], 
+                        summary['npar'], summary['sec_per_scf']):
+                continue
+            summary['nk'] = nk
+            summary['nbands'] = outcar.contents.get('nbands')
+            summary['cost'] = summary['sec_per_scf'] * summary['ncores'] / nk
+            self.samples.append(summary)
+        return self.samples
+
+    def best_setting(self):
+        '''returns (cores per k-point group, NPAR, cost, mean SCF iterations)
+            of the setting with the lowest mean cost,
+            None if nothing has been learned'''
+        groups = {}
+        for smp in self.samples:
+            key = (smp['ncores'] // smp['kpar'], smp['npar'])
+            groups.setdefault(key, []).append(smp)
+        best = None
+        for (ngroup, npar), smps in groups.items():
+            cost = sum([smp['cost'] for smp in smps]) / len(smps)
+            nscf = sum([smp['nscf'] for smp in smps]) / len(smps)
+            if best is None or cost < best[2]:
+                best = (ngroup, npar, cost, nscf)
+        return best
+
+    def propose(self, nk, nbands=None, nscf=None):
+        '''proposes the settings for a new experiment
+                nk:     the number of irreducible k-points
+                nbands: the number of bands, limits NPAR if given
+                nscf:   the expected number of SCF iterations, 
+                        defaults to the mean of the best learned setting
+            returns {'KPAR', 'NPAR', '-n', '-N', '-t'}'''
+        best = self.best_setting()
+        if best is None:
+            ngroup, npar = self.default_group, None
+        else:
+            ngroup, npar, cost, nscf_ = best
+        ngroup = min(ngroup, self.max_cores)
+        kpar = max([d for d in self.divisors(nk) 
+                      if d * ngroup <= self.max_cores] + [1])
+        if npar is None or ngroup % npar != 0:
+            npar = min(self.divisors(ngroup), 
+                       key=lambda d: abs(d - math.sqrt(ngroup)))
+        if nbands is not None:
+            npar = max([d for d in self.divisors(ngroup) 
+                          if d <= min(npar, nbands)])
+        ncores = kpar * ngroup
+        proposal = {
+            'KPAR': kpar, 'NPAR': npar, 
+            '-n': ncores, 
+            '-N': int(math.ceil(ncores / float(self.cores_per_node))),
+        }
+        if best is not None:
+            nscf = nscf_ if nscf is None else nscf
+            seconds = cost * nk * nscf / ncores * self.time_margin
+            proposal['-t'] = self.format_time(seconds)
+        return proposal
+
+    def apply(self, exp_dir, nk, nbands=None, nscf=None, 
+              batch_name='batch.sh'):
+        '''writes the proposal into the INCAR and batch file of an experiment,
+            the keys missing from the files are added, the Slurm options 
+            are written in the form the batch file already uses (e.g. --time)'''
+        proposal = self.propose(nk, nbands, nscf)
         ToolKit.alter_file(
             vasp.VaspINCAR, 
             os.path.join(exp_dir, 'INCAR'), 
-            configs={'SAXIS': '{} {} {}'.format(*p)})
-        
\ No newline at end of file
+            configs={k: proposal[k] for k in ['KPAR', 'NPAR']}, append=True)
+        fpath = os.path.join(exp_dir, batch_name)
+        keys = slurm.SlurmBatchScript.load(fpath).contents
+        configs = {}
+        for k, v in proposal.items():
+            if k.startswith('-'):
+                alias = self.SLURM_ALIASES[k]
+                configs[alias if alias in keys and k not in keys else k] = v
+        ToolKit.alter_file(slurm.SlurmBatchScript, fpath, configs=configs, append=True)
+        return proposal
+
+    @staticmethod
+    def divisors(n):
+        return [d for d in range(1, n+1) if n % d == 0]
+
+    @staticmethod
+    def format_time(seconds):
+        '''formats the seconds as d-HH:MM, rounded up to minutes'''
+        minutes = max(int(math.ceil(seconds / 60.)), 1)
+        days, minutes = divmod(minutes, 24*60)
+        hours, minutes = divmod(minutes, 60)
+        return '{}-{:02d}:{:02d}'.format(days, hours, minutes)
@@ -0,0 +1,191 @@
+'''
+Batched curve fitting
+fits the energy curves of many scan sets at once, each set is a row of
+a 2D array padded by NaN, e.g. all strains of all materials:
+
+    alat:       (nsets, npoints)
+    energies:   (nsets, npoints)
+
+every fit is a masked linear least squares solved for all rows together,
+so there is no loop over the sets
+'''
+
+import warnings
+import numpy as np
+
+EV_PER_A3_TO_GPA = 160.21766208
+
+
+
+def pad(groups, fill=np.nan):
+    '''[<1D array>, ...] -> (ngroups, max length) array padded by fill'''
+    result = np.full((len(groups), max([len(g) for g in groups] + [0])), fill)
+    for i, g in enumerate(groups):
+        result[i, :len(g)] = g
+    return result
+
+
+
+def collect(store, param, column='energy', key=np.prod):
+    '''reads the curves of every set in a ResultStore (see store.py),
+        param:  the scan parameter, read from the column param.<param>
+        key:    reduces an array parameter (e.g. a k-point grid) to a number
+        returns (set names, parameters, values) with one row per set'''
+    result = store.read(['param.' + param, column])
+    params = result['param.' + param]
+    if isinstance(params, list):
+        params = np.array([np.nan if p is None else key(p) for p in params])
+    else:
+        params = np.where(params == '', 'nan', params).astype(float)
+    values = np.asarray(result[column], dtype=float)
+    sets = np.array([exp_id.rpartition('/')[0] for exp_id in result['id']])
+    scanned = ~np.isnan(params)
+    params, values, sets = params[scanned], values[scanned], sets[scanned]
+    names = sorted(set(sets.tolist()))
+    xs = [params[sets == name] for name in names]
+    ys = [values[sets == name] for name in names]
+    return names, pad(xs), pad(ys)
+
+
+
+def polyfit(x, y, deg):
+    '''fits y = sum_k c_k t^k for every row, where t = (x - center) / scale,
+        NaN points are left out, rows with too few points give NaN
+        returns (coefs lowest order first, center, scale)'''
+    mask = ~(np.isnan(x) | np.isnan(y))
+    count = mask.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        center = np.sum(np.where(mask, x, 0.), axis=1) / count
+        scale = np.sqrt(np.sum(np.where(mask, x - center[:, None], 0.)**2, axis=1) / count)
+    scale[~(scale > 0)] = 1.
+    t = np.where(mask, (x - center[:, None]) / scale[:, None], 0.)
+    vander = t[..., None] ** np.arange(deg + 1) * mask[..., None]
+    lhs = np.einsum('spi,spj->sij', vander, vander)
+    rhs = np.einsum('spi,sp->si', vander, np.where(mask, y, 0.))
+    bad = count < deg + 1
+    lhs[bad] = np.eye(deg + 1)
+    coefs = np.linalg.solve(lhs, rhs[..., None])[..., 0]
+    coefs[bad] = np.nan
+    return coefs, center, scale
+
+
+def polyval(coefs, t, der=0):
+    '''evaluates the der-th derivative of the polynomials at t, row by row'''
+    for _ in range(der):
+        coefs = coefs[:, 1:] * np.arange(1, coefs.shape[1])
+    if coefs.shape[1] == 0:
+        return np.zeros_like(t)
+    return np.sum(coefs * t[:, None] ** np.arange(coefs.shape[1]), axis=1)
+
+
+def polymin(coefs, lo, hi, rtol=1e-10):
+    '''the lowest local minimum of each polynomial within [lo, hi],
+        the stationary points are the eigenvalues of the companion matrices
+        of the derivatives, whose leading coefficients below rtol (relative 
+        to the largest one) are dropped first, e.g. the vanishing cubic term 
+        of a Birch-Murnaghan EOS with B0'=4, returns (t, value), NaN if none'''
+    nsets = len(coefs)
+    deriv = coefs[:, 1:] * np.arange(1, coefs.shape[1])
+    n = deriv.shape[1] - 1
+    if n < 1:
+        return np.full(nsets, np.nan), np.full(nsets, np.nan)
+    size = np.abs(deriv)
+    kept = size > rtol * np.max(size, axis=1, keepdims=True)
+    # the degree that remains, -1 for the rows of NaN or zeros
+    degree = n - np.argmax(kept[:, ::-1], axis=1)
+    degree[~np.any(kept, axis=1)] = -1
+    roots = np.full((nsets, n), np.nan, dtype=complex)
+    for d in range(1, n + 1):
+        sub = np.nonzero(degree == d)[0]
+        if len(sub) == 0:
+            continue
+        companion = np.zeros((len(sub), d, d))
+        companion[:, np.arange(1, d), np.arange(d - 1)] = 1.
+        companion[:, :, -1] = -deriv[sub, :d] / deriv[sub, d:d+1]
+        roots[sub, :d] = np.linalg.eigvals(companion)
+    real = np.abs(roots.imag) <= 1e-9 * np.maximum(1., np.abs(roots.real))
+    roots = roots.real
+    curv = np.stack([polyval(coefs, roots[:, j], der=2) for j in range(n)], axis=1)
+    vals = np.stack([polyval(coefs, roots[:, j]) for j in range(n)], axis=1)
+    with np.errstate(invalid='ignore'):
+        valid = real & (curv > 0) & (roots >= lo[:, None]) & (roots <= hi[:, None])
+    vals = np.where(valid, vals, np.inf)
+    best = np.argmin(vals, axis=1)
+    rows = np.arange(nsets)
+    found = valid[rows, best]
+    return (np.where(found, roots[rows, best], np.nan),
+            np.where(found, vals[rows, best], np.nan))
+
+
+
+def eos(volumes, energies, form='birch_murnaghan', deg=3):
+    '''fits the equation of state of every row,
+        form:   'birch_murnaghan', the third order Birch-Murnaghan EOS,
+                which is exactly a cubic polynomial in V^(-2/3)
+                'polynomial', a polynomial of degree deg in V
+        the minimum is searched within the scanned volumes only,
+        returns {'V0', 'E0', 'B0', 'B0p'} of arrays,
+        B0 in the unit of energy/volume (see EV_PER_A3_TO_GPA)'''
+    with warnings.catch_warnings():
+        # the rows of NaN only give NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        vref = np.nanmean(volumes, axis=1)
+    if form == 'birch_murnaghan':
+        x = (volumes / vref[:, None]) ** (-2./3)
+        coefs, center, scale = polyfit(x, energies, 3)
+    elif form == 'polynomial':
+        x = volumes / vref[:, None]
+        coefs, center, scale = polyfit(x, energies, deg)
+    else:
+        raise ValueError('unknown form {}'.format(form))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lo = (np.nanmin(x, axis=1) - center) / scale
+        hi = (np.nanmax(x, axis=1) - center) / scale
+    t0, E0 = polymin(coefs, np.minimum(lo, hi), np.maximum(lo, hi))
+    x0 = center + scale * t0
+    # derivatives of x over V at the minimum, where dE/dx = 0
+    if form == 'birch_murnaghan':
+        V0 = vref * x0 ** (-3./2)
+        dx = -2./3 * x0 / V0
+        ddx = 10./9 * x0 / V0**2
+    else:
+        V0 = vref * x0
+        dx = 1. / vref
+        ddx = 0.
+    Exx = polyval(coefs, t0, der=2) / scale**2
+    Exxx = polyval(coefs, t0, der=3) / scale**3
+    EVV = Exx * dx**2
+    EVVV = Exxx * dx**3 + 3 * Exx * dx * ddx
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {'V0': V0, 'E0': E0, 'B0': V0 * EVV,
+                'B0p': -(1. + V0 * EVVV / EVV)}
+
+
+def lattice_eos(alat, energies, dim=3, factor=1., **kwargs):
+    '''the same as eos, but over lattice constants, V = factor * alat^dim,
+        e.g. dim=2 for the area of a monolayer, where B0 becomes the 2D modulus,
+        returns the equilibrium lattice constants as 'a0' in addition'''
+    result = eos(factor * alat**dim, energies, **kwargs)
+    result['a0'] = (result['V0'] / factor) ** (1. / dim)
+    return result
+
+
+
+def converged(params, energies, tol=1e-3):
+    '''the smallest parameter of each row from which on the energies stay
+        within tol of the energy at the largest parameter, e.g. the converged
+        ENCUT of an ENCUT scan, NaN if only the largest parameter qualifies'''
+    nsets = len(params)
+    mask = ~(np.isnan(params) | np.isnan(energies))
+    order = np.argsort(np.where(mask, params, np.inf), axis=1)
+    x = np.take_along_axis(params, order, axis=1)
+    y = np.take_along_axis(energies, order, axis=1)
+    mask = np.take_along_axis(mask, order, axis=1)
+    count = mask.sum(axis=1)
+    rows = np.arange(nsets)
+    ref = y[rows, np.maximum(count - 1, 0)]
+    ok = (np.abs(y - ref[:, None]) <= tol) | ~mask
+    tail = np.logical_and.accumulate(ok[:, ::-1], axis=1)[:, ::-1]
+    first = np.argmax(tail, axis=1)
+    return np.where(first < count - 1, x[rows, first], np.nan)
@@ -0,0 +1,146 @@
+'''
+Experiment set manifest
+kept free of numpy, so that the submission and status tools load fast
+'''
+
+import os, json
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+
+class SetManifest:
+    '''the structured record of an experiment set, 
+        kept as <set root>/manifest.json in the form of
+
+            {<experiment name>: {
+                'hash':     <hash of the rendered inputs>,
+                'params':   {<parameter name>: <value>, ...},
+                'status':   'created', 'submitted', 'completed' or 'failed',
+                'jobid':    <Slurm job ID> or None,
+                'submitted': <time of the submission, seconds since the epoch>,
+                'key':      <ResultRegistry key of the inputs as created>,
+            }}
+
+        so that the experiments can be found without walking the set'''
+
+    FNAME = 'manifest.json'
+
+    def __init__(self, set_dir):
+        self.set_dir = set_dir
+        self.fpath = os.path.join(set_dir, self.FNAME)
+        self.records = {}
+        if os.path.isfile(self.fpath):
+            with open(self.fpath, 'r') as file:
+                self.records = json.load(file)
+
+    def save(self):
+        '''writes the manifest through a rename, never leaves it half written'''
+        tmppath = '{}.{}.tmp'.format(self.fpath, os.getpid())
+        with open(tmppath, 'w') as file:
+            json.dump(self.records, file, indent=1, sort_keys=True)
+        os.rename(tmppath, self.fpath)
+
+    def params(self, exp_name):
+        return self.records.get(exp_name, {}).get('params', {})
+
+    def update(self, exp_name, **fields):
+        self.records.setdefault(exp_name, {}).update(fields)
+
+    def query(self, status=None, **conditions):
+        '''returns the names of the experiments that match all conditions,
+            a condition is either a value to compare with 
+            or a function that takes the value and returns a bool, e.g.
+                query(status='completed', saxis=[0,0,1], ecut=lambda e: e >= 400)'''
+        conditions = {k: c if callable(c) else self.jsonify(c) 
+                      for k, c in conditions.items()}
+        result = []
+        for exp_name in sorted(self.records):
+            record = self.records[exp_name]
+            if status is not None and record.get('status') != status:
+                continue
+            params = record.get('params', {})
+            if all(self.match(params, k, c) for k, c in conditions.items()):
+                result.append(exp_name)
+        return result
+
+    def paths(self, *args, **kwargs):
+        '''the same as query, but returns the experiment directories'''
+        return [os.path.join(self.set_dir, exp_name) 
+                for exp_name in self.query(*args, **kwargs)]
+
+    def record_log(self, logpath):
+        '''reads the log written by submit_exhaustive, lines like
+                Submitted batch job <jobid> \t<path to batch file>
+                <exit status> \t<path to batch file>       (packing mode)'''
+        with open(logpath, 'r') as file:
+            for line in file:
+                message, _, fpath = line.rstrip('\n').partition('\t')
+                exp_name = os.path.basename(os.path.dirname(fpath.strip()))
+                if exp_name not in self.records:
+                    continue
+                message = message.strip()
+                if message.startswith('Submitted batch job'):
+                    self.update(exp_name, status='submitted', 
+                                jobid=message.split()[-1], submitted=None)
+                elif message == '0':
+                    self.update(exp_name, status='completed')
+                else:
+                    self.update(exp_name, status='failed')
+
+    def refresh(self, outname='OUTCAR', tail=4096):
+        '''marks the submitted experiments whose OUTCAR ends with 
+            the general timing informations as completed'''
+        for exp_name in self.query(status='submitted'):
+            fpath = os.path.join(self.set_dir, exp_name, outname)
+            if not os.path.isfile(fpath):
+                continue
+            with open(fpath, 'rb') as file:
+                file.seek(max(os.path.getsize(fpath) - tail, 0))
+                if b'General timing and accounting' in file.read():
+                    self.update(exp_name, status='completed')
+
+    @staticmethod
+    def match(params, key, condition):
+        if key not in params:
+            return False
+        if callable(condition):
+            return condition(params[key])
+        return params[key] == condition
+
+    @staticmethod
+    def jsonify(obj):
+        '''converts tuples and numpy types into plain json types'''
+        return json.loads(json.dumps(obj, default=lambda o: o.tolist()))
+
+
+
+class SetLock:
+    '''
+    an advisory file lock that serializes the updates of the set-level 
+    metadata (the set root, info.txt, the manifest) across processes,
+    the designed syntax is like:
+        with SetLock(set_dir):
+            do something
+    the lock file sits beside the set root, so that it guards the creation 
+    of the root as well. POSIX locks are used as they also work on NFS.
+    the lock file (.<set name>.lock) is left in place on purpose, removing it
+    while another process waits on it would let two processes in at once,
+    it is empty and safe to delete when no process works on the set.
+    the lock is not reentrant within one process
+    '''
+    def __init__(self, set_dir):
+        set_dir = os.path.abspath(set_dir)
+        self.fpath = os.path.join(os.path.dirname(set_dir), 
+                                  '.{}.lock'.format(os.path.basename(set_dir)))
+    def __enter__(self):
+        self.file = open(self.fpath, 'a')
+        if fcntl is not None:
+            fcntl.lockf(self.file, fcntl.LOCK_EX)
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl is not None:
+            fcntl.lockf(self.file, fcntl.LOCK_UN)
+        self.file.close()
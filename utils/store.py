@@ -0,0 +1,317 @@
+'''
+Columnar results store
+keeps the harvested results of many experiment sets in one place,
+HDF5 (h5py) is used if available, otherwise chunks of .npz files
+'''
+
+import os, re, json
+import numpy as np
+from utils.manifest import SetLock
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+
+def open_store(path):
+    '''opens an existing store by its type, or creates one,
+        a new store is an HDF5 file if h5py is available,
+        otherwise a directory of .npz chunks'''
+    if os.path.isdir(path):
+        return NpzStore(path)
+    if os.path.isfile(path) or (h5py is not None and path.endswith('.h5')):
+        return HDF5Store(path)
+    if h5py is not None:
+        return HDF5Store(path)
+    return NpzStore(path)
+
+
+
+class ResultStore:
+    '''an append-only table of per-experiment results,
+        indexed by experiment ID, a record is like
+
+            {<column>: <scalar or array>}
+
+        scalar columns are kept as 1D arrays, array columns are kept
+        flattened, along with the shape of each row, so that e.g. the forces
+        of relaxations with different numbers of ionic steps or atoms share 
+        one column, only the number of dimensions is fixed per column.
+        a numeric column is promoted as numpy does (e.g. int to float, 
+        the same in both backends), but never mixes with strings.
+        appending an existing ID supersedes its previous record'''
+
+    def append(self, records):
+        '''records: {<experiment ID>: {<column>: <value>}}, None values are skipped'''
+        ids = list(records)
+        entries = {}
+        for i, exp_id in enumerate(ids):
+            for col, val in records[exp_id].items():
+                if val is None:
+                    continue
+                val = np.asarray(val)
+                if val.dtype == object:
+                    raise TypeError('{} of {} is not an array of one type'.format(col, exp_id))
+                entries.setdefault(col, []).append((i, val))
+        with SetLock(self.path):
+            start = self.nrows()
+            kinds = self.kinds()
+            columns = {}
+            for col, items in entries.items():
+                rows = np.array([start + i for i, _ in items], dtype=np.int64)
+                vals = [v for _, v in items]
+                ndim, dtype = kinds.get(col, (vals[0].ndim, None))
+                if any(v.ndim != ndim for v in vals):
+                    raise ValueError('{} takes {}-dimensional values'.format(col, ndim))
+                dtypes = [v.dtype for v in vals] + ([] if dtype is None else [dtype])
+                if len(set(dt.kind in 'SU' for dt in dtypes)) > 1:
+                    raise TypeError('{} mixes strings with numbers'.format(col))
+                if ndim > 0:
+                    columns[col] = (rows, np.concatenate([v.ravel() for v in vals]),
+                                    np.array([v.shape for v in vals], dtype=np.int64))
+                else:
+                    columns[col] = (rows, np.array(vals), None)
+            self.write(start, np.array(ids, dtype=str), columns)
+        return start
+
+    def ids(self):
+        '''the current experiment IDs in the order they were appended'''
+        allids = self.read_ids()
+        return allids[self.latest(allids)]
+
+    def read(self, columns=None, ids=None, fill=np.nan):
+        '''reads only the given columns, of all or the given IDs,
+            returns {'id': <IDs>, <column>: <values>}, where the scalar
+            columns are arrays aligned with the IDs (missing values are fill,
+            or '' for strings), and the array columns are lists of views
+            (missing values are None)'''
+        allids = self.read_ids()
+        sel = self.latest(allids)
+        if ids is not None:
+            where = dict(zip(allids[sel], sel))
+            sel = np.array([where[exp_id] for exp_id in ids], dtype=np.int64)
+        pos = np.full(len(allids), -1, dtype=np.int64)
+        pos[sel] = np.arange(len(sel))
+        result = {'id': allids[sel]}
+        for col in (self.columns() if columns is None else columns):
+            rows, data, shapes = self.read_column(col)
+            at = pos[rows]
+            valid = at >= 0
+            if shapes is None:
+                if data.dtype.kind in 'SU' or valid.sum() == len(sel):
+                    values = np.zeros(len(sel), dtype=data.dtype)
+                else:
+                    values = np.full(len(sel), fill, dtype=np.result_type(data.dtype, np.float64))
+                values[at[valid]] = data[valid]
+            else:
+                offsets = np.concatenate([[0], np.cumsum(np.prod(shapes, axis=1))])
+                values = [None] * len(sel)
+                for k in np.nonzero(valid)[0]:
+                    values[at[k]] = data[offsets[k]:offsets[k+1]].reshape(shapes[k])
+            result[col] = values
+        return result
+
+    @staticmethod
+    def latest(allids):
+        '''the rows that hold the latest record of each ID, in order'''
+        _, index = np.unique(allids[::-1], return_index=True)
+        return np.sort(len(allids) - 1 - index)
+
+    def nrows(self):
+        raise NotImplementedError
+    def kinds(self):
+        '''{<column>: (<number of dimensions of its values>, <dtype>)}'''
+        raise NotImplementedError
+    def columns(self):
+        return sorted(self.kinds())
+    def read_ids(self):
+        '''the IDs of all rows, superseded ones included'''
+        raise NotImplementedError
+    def read_column(self, col):
+        '''returns (rows, data, shapes), shapes is None for scalar columns'''
+        raise NotImplementedError
+    def write(self, start, ids, columns):
+        raise NotImplementedError
+
+
+
+class NpzStore(ResultStore):
+    '''a directory of chunks named chunk_<first row>_<number of rows>.npz,
+        each append writes one chunk, np.load reads the members lazily
+        so that only the requested columns are decompressed,
+        the columns are listed in index.json as {<column>: [ndim, dtype]}, 
+        so that an append never opens the chunks'''
+
+    CHUNK = re.compile(r'^chunk_(\d+)_(\d+)\.npz$')
+    INDEX = 'index.json'
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def chunks(self):
+        '''[(first row, number of rows, path)] in order'''
+        result = []
+        for fname in os.listdir(self.path):
+            m = self.CHUNK.match(fname)
+            if m:
+                result.append((int(m.group(1)), int(m.group(2)),
+                               os.path.join(self.path, fname)))
+        return sorted(result)
+
+    def nrows(self):
+        return sum(n for _, n, _ in self.chunks())
+
+    def kinds(self):
+        fpath = os.path.join(self.path, self.INDEX)
+        if not os.path.isfile(fpath):
+            return {}
+        with open(fpath, 'r') as file:
+            return {col: (ndim, np.dtype(dtype)) 
+                    for col, (ndim, dtype) in json.load(file).items()}
+
+    def read_ids(self):
+        ids = []
+        for _, _, fpath in self.chunks():
+            with np.load(fpath) as chunk:
+                ids.append(chunk['__ids__'])
+        return np.concatenate(ids) if ids else np.array([], dtype=str)
+
+    def read_column(self, col):
+        rows, data, shapes = [], [], []
+        for _, _, fpath in self.chunks():
+            with np.load(fpath) as chunk:
+                if col + '.rows' not in chunk.files:
+                    continue
+                rows.append(chunk[col + '.rows'])
+                data.append(chunk[col + '.data'])
+                if col + '.shapes' in chunk.files:
+                    shapes.append(chunk[col + '.shapes'])
+        if not rows:
+            raise KeyError(col)
+        return (np.concatenate(rows), np.concatenate(data),
+                np.concatenate(shapes) if shapes else None)
+
+    def write(self, start, ids, columns):
+        arrays = {'__ids__': ids}
+        kinds = self.kinds()
+        for col, (rows, data, shapes) in columns.items():
+            arrays[col + '.rows'] = rows
+            arrays[col + '.data'] = data
+            if shapes is not None:
+                arrays[col + '.shapes'] = shapes
+            ndim, dtype = kinds.get(col, (None, data.dtype))
+            kinds[col] = (0 if shapes is None else shapes.shape[1],
+                          np.result_type(dtype, data.dtype))
+        index = {col: [ndim, dtype.str] for col, (ndim, dtype) in kinds.items()}
+        fpath = os.path.join(self.path, 'chunk_{:010d}_{:d}.npz'.format(start, len(ids)))
+        self.save(fpath, lambda file: np.savez_compressed(file, **arrays), 'wb')
+        self.save(os.path.join(self.path, self.INDEX), 
+                  lambda file: json.dump(index, file, sort_keys=True), 'w')
+
+    @staticmethod
+    def save(fpath, dump, mode):
+        '''writes through a rename, never leaves a file half written'''
+        tmppath = '{}.{}.tmp'.format(fpath, os.getpid())
+        with open(tmppath, mode) as file:
+            dump(file)
+        os.rename(tmppath, fpath)
+
+    def compact(self):
+        '''merges all chunks into one, appending one job at a time
+            leaves many small chunks behind'''
+        with SetLock(self.path):
+            chunks = self.chunks()
+            if len(chunks) < 2:
+                return
+            columns = {col: self.read_column(col) for col in self.kinds()}
+            self.write(0, self.read_ids(), columns)
+            for _, _, fpath in chunks:
+                os.remove(fpath)
+
+
+
+class HDF5Store(ResultStore):
+    '''a single HDF5 file, laid out as /ids and /columns/<column>/{rows,data,shapes},
+        all datasets are chunked and resizable along the first axis'''
+
+    def __init__(self, path):
+        if h5py is None:
+            raise ImportError('h5py is required for {}'.format(path))
+        self.path = path
+
+    def nrows(self):
+        if not os.path.isfile(self.path):
+            return 0
+        with h5py.File(self.path, 'r') as file:
+            return len(file['ids'])
+
+    def kinds(self):
+        if not os.path.isfile(self.path):
+            return {}
+        with h5py.File(self.path, 'r') as file:
+            if 'columns' not in file:
+                return {}
+            return {col: (group['shapes'].shape[1] if 'shapes' in group else 0,
+                          self.dtype(group['data']))
+                    for col, group in file['columns'].items()}
+
+    def read_ids(self):
+        if not os.path.isfile(self.path):
+            return np.array([], dtype=str)
+        with h5py.File(self.path, 'r') as file:
+            return np.array(file['ids'].asstr()[...], dtype=str)
+
+    def read_column(self, col):
+        with h5py.File(self.path, 'r') as file:
+            group = file['columns'][col]
+            data = group['data']
+            if h5py.check_string_dtype(data.dtype) is not None:
+                data = np.array(data.asstr()[...], dtype=str)
+            else:
+                data = data[...]
+            shapes = group['shapes'][...] if 'shapes' in group else None
+            return group['rows'][...], data, shapes
+
+    def write(self, start, ids, columns):
+        with h5py.File(self.path, 'a') as file:
+            self.extend(file, 'ids', ids)
+            group = file.require_group('columns')
+            for col, (rows, data, shapes) in columns.items():
+                sub = group.require_group(col)
+                self.extend(sub, 'rows', rows)
+                self.extend(sub, 'data', data)
+                if shapes is not None:
+                    self.extend(sub, 'shapes', shapes)
+
+    @staticmethod
+    def dtype(dataset):
+        '''the numpy dtype of the values, str for the strings'''
+        if h5py.check_string_dtype(dataset.dtype) is not None:
+            return np.dtype(str)
+        return dataset.dtype
+
+    @classmethod
+    def extend(cls, group, name, values):
+        if values.dtype.kind == 'U':
+            values = values.astype(object)
+            dtype = h5py.string_dtype()
+        else:
+            dtype = values.dtype
+        if name in group and dtype != h5py.string_dtype():
+            promoted = np.result_type(cls.dtype(group[name]), dtype)
+            if promoted != group[name].dtype:
+                # the dataset type is fixed once created, rewritten as promoted
+                old = group[name][...].astype(promoted)
+                del group[name]
+                cls.extend(group, name, old)
+                dtype = promoted
+        if name not in group:
+            group.create_dataset(name, data=values, dtype=dtype, chunks=True,
+                                 maxshape=(None,) + values.shape[1:])
+            return
+        dataset = group[name]
+        n = len(dataset)
+        dataset.resize(n + len(values), axis=0)
+        dataset[n:] = values
@@ -4,6 +4,7 @@ Author: Yiqi Xie
 Date:   May 9, 2018
 '''
 
+import itertools
 import numpy as np
 
 class MonoLayerCrI3:
@@ -58,4 +59,191 @@ class MonoLayerCrI3:
         self.cartesian = np.dot(self.direct, self.cell)
 
 
-        
\ No newline at end of file
+
+class Structure:
+    '''a general structure backed by arrays,
+
+        INPUTS:
+            species:    str sequence, symbol of each ion
+            cell:       array like, basis vectors, in angstrum
+            direct:     array like, atom positions, in lattice coordinate
+            cartesian:  array like, atom positions, in cartesian coordinate,
+                        used only if direct is None
+
+        ATTRIBUTES:
+            species:    numpy array, symbol of each ion, grouped by symbol
+            cell:       numpy array, basis vectors, in angstrum
+            direct:     numpy array, atom positions, in lattice coordinate
+            cartesian:  numpy array, atom positions, in cartesian coordinate
+            symbols:    str tuple, symbol of ions, order matters
+            numbers:    int tuple, number of ions, order matters
+            a:          float, length of the first basis vector
+
+        INTERFACES:
+            the same as MonoLayerCrI3, so that it works with
+            ToolKit.make_poscar_abs and StrucScanFromTemplate
+    '''
+
+    def __init__(self, species, cell, direct=None, cartesian=None):
+        self.cell = np.array(cell, dtype=float)
+        if direct is None:
+            direct = np.dot(cartesian, np.linalg.inv(self.cell))
+        species, direct = group_species(species, direct)
+        self.species = species
+        self.direct = direct
+        self.symbols, self.numbers = count_species(species)
+
+    @property
+    def cartesian(self):
+        return np.dot(self.direct, self.cell)
+
+    @property
+    def a(self):
+        return float(np.linalg.norm(self.cell[0]))
+
+    @classmethod
+    def from_struc(cls, struc):
+        '''struc should resemble the ones defined in this file'''
+        species = np.repeat(struc.symbols, struc.numbers)
+        return cls(species, struc.cell, direct=struc.direct)
+
+    @classmethod
+    def from_poscar(cls, fpath):
+        from utils import vasp
+        contents = vasp.VaspPOSCAR.load(fpath).contents
+        cell = contents['cell'] * contents['scale']
+        species = np.repeat(contents['symbols'], contents['numbers'])
+        if contents['direct']:
+            return cls(species, cell, direct=contents['positions'])
+        return cls(species, cell, cartesian=contents['positions'] * contents['scale'])
+
+    def batch(self, n=1):
+        '''n copies of the structure as a StructureBatch'''
+        return StructureBatch(self.species, 
+                              np.repeat(self.cell[None], n, axis=0),
+                              np.repeat(self.direct[None], n, axis=0))
+
+
+
+class StructureBatch:
+    '''many structures of the same species in the same order,
+
+        INPUTS:
+            species:    str sequence, symbol of each ion, grouped by symbol
+            cells:      (nstrucs, 3, 3) array, basis vectors, in angstrum
+            direct:     (nstrucs, natoms, 3) array, atom positions, 
+                        in lattice coordinate
+
+        every operation works on all structures at once and returns a new batch,
+        e.g. 10^5 perturbed supercells for a training set:
+            Structure(...).batch(10**5).supercell((2,2,1)).rattle(0.05)
+    '''
+
+    def __init__(self, species, cells, direct):
+        self.species = np.asarray(species)
+        self.cells = np.asarray(cells, dtype=float)
+        self.direct = np.asarray(direct, dtype=float)
+        self.symbols, self.numbers = count_species(self.species)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __getitem__(self, i):
+        return Structure(self.species, self.cells[i], direct=self.direct[i])
+
+    @property
+    def cartesian(self):
+        return np.matmul(self.direct, self.cells)
+
+    def supercell(self, scaling):
+        '''scaling:    3 integers, or a 3x3 integer matrix P, 
+                        the new basis vectors are P @ cell
+            the images of each ion stay next to each other'''
+        P = np.array(scaling, dtype=int)
+        if P.ndim == 1:
+            P = np.diag(P)
+        n = int(round(abs(np.linalg.det(P))))
+        # the lattice points of the old cell inside the new cell
+        corners = np.array([[i, j, k] for i in (0, 1) for j in (0, 1) 
+                            for k in (0, 1)]).dot(P)
+        ranges = [np.arange(lo, hi + 1) for lo, hi in 
+                  zip(corners.min(axis=0), corners.max(axis=0))]
+        grid = np.stack(np.meshgrid(*ranges, indexing='ij'), axis=-1).reshape(-1, 3)
+        Pinv = np.linalg.inv(P)
+        frac = grid.dot(Pinv)
+        eps = 1e-8
+        inside = np.all((frac > -eps) & (frac < 1 - eps), axis=1)
+        shifts = grid[inside]
+        if len(shifts) != n:
+            raise ValueError('failed to find the {} images of {}'.format(n, P))
+        direct = (self.direct[:, :, None, :] + shifts).dot(Pinv)
+        direct = np.mod(direct, 1.).reshape(len(self), -1, 3)
+        cells = np.matmul(P.astype(float), self.cells)
+        return StructureBatch(np.repeat(self.species, n), cells, direct)
+
+    def strain(self, strains):
+        '''strains:    a 3x3 strain tensor, or one per structure (nstrucs, 3, 3),
+            the basis vectors are deformed by (I + strain), 
+            the lattice coordinates stay'''
+        F = np.eye(3) + np.asarray(strains, dtype=float)
+        cells = np.matmul(self.cells, np.swapaxes(F, -1, -2))
+        return StructureBatch(self.species, cells, self.direct.copy())
+
+    def rattle(self, sigma, seed=None):
+        '''displaces every ion randomly, the cartesian displacements 
+            are normally distributed with the standard deviation sigma'''
+        rng = np.random.default_rng(seed)
+        disp = rng.normal(0., sigma, self.direct.shape)
+        direct = self.direct + np.matmul(disp, np.linalg.inv(self.cells))
+        return StructureBatch(self.species, self.cells.copy(), direct)
+
+    def vacancies(self, symbol, k=1):
+        '''removes every combination of k ions of symbol from each structure,
+            the result is ordered as (structure, combination)'''
+        sites = np.nonzero(self.species == symbol)[0]
+        if not 0 < k <= len(sites):
+            raise ValueError('cannot remove {} of the {} {} ions'.format(k, len(sites), symbol))
+        combos = np.array(list(itertools.combinations(sites, k)), dtype=int)
+        natoms = len(self.species)
+        mask = np.ones((len(combos), natoms), dtype=bool)
+        mask[np.arange(len(combos))[:, None], combos] = False
+        keeps = np.argsort(~mask, axis=1, kind='stable')[:, :natoms - k]
+        direct = self.direct[:, keeps].reshape(-1, natoms - k, 3)
+        cells = np.repeat(self.cells, len(combos), axis=0)
+        return StructureBatch(self.species[keeps[0]], cells, direct)
+
+    def poscars(self, header='POSCAR', direct=True, floatfmt='%19.16f'):
+        '''yields the POSCAR lines of each structure, 
+            the same as VaspPOSCAR.create (without selective dynamics),
+            but every block is formatted by one printf-style operation'''
+        row = ' '.join([floatfmt] * 3) + '\n'
+        positions = self.direct if direct else self.cartesian
+        natoms = len(self.species)
+        first = str(header).strip() + '\n' + floatfmt % 1. + '\n'
+        head = ''.join(['{:>4s}'.format(s) for s in self.symbols]) + '\n' \
+             + ''.join(['{:>4d}'.format(n) for n in self.numbers]) + '\n' \
+             + ('Direct' if direct else 'Cartesian') + '\n'
+        fmt = first.replace('%', '%%') + row * 3 + head.replace('%', '%%') + row * natoms
+        for cell, pos in zip(self.cells, positions):
+            values = tuple(cell.ravel().tolist() + pos.ravel().tolist())
+            yield (fmt % values).splitlines(True)
+
+
+
+def group_species(species, direct):
+    '''sorts the ions by symbol in the order of first appearance, stably'''
+    species = np.asarray(species)
+    _, first, inverse = np.unique(species, return_index=True, return_inverse=True)
+    rank = np.argsort(np.argsort(first))
+    order = np.argsort(rank[inverse.ravel()], kind='stable')
+    return species[order], np.asarray(direct, dtype=float)[order]
+
+
+def count_species(species):
+    '''returns (symbols, numbers) as in POSCAR, species should be grouped'''
+    species = list(species)
+    symbols = tuple(s for i, s in enumerate(species) if i == 0 or s != species[i-1])
+    numbers = tuple(species.count(s) for s in symbols)
+    if len(set(symbols)) != len(symbols):
+        raise ValueError('the species are not grouped by symbol')
+    return tuple(str(s) for s in symbols), numbers
@@ -9,8 +9,9 @@ Date:   May 9, 2018
 '''
 
 
-import os, sys, shutil
-import time, io
+import os, sys, shutil, re
+import time, io, json
+import subprocess
 
 
 class ChangeWD:
@@ -49,6 +50,33 @@ def exhaust(root, depth=1, match=lambda fn:True):
 
 
 
+def recorded(root, statuses, fname='manifest.json'):
+    '''lists the experiments of the given statuses in the manifest of the set'''
+    fpath = os.path.join(root, fname)
+    if not os.path.isfile(fpath):
+        return set()
+    with open(fpath, 'r') as file:
+        records = json.load(file)
+    return set([name for name, record in records.items() 
+                if record.get('status') in statuses])
+
+
+
+def completed(root, fname='manifest.json'):
+    '''lists the experiments marked as completed in the manifest of the set'''
+    return recorded(root, ('completed',), fname)
+
+
+
+def pending(root, fpathlist, skip=('completed', 'submitted')):
+    '''drops the scripts of the completed experiments, and of the submitted 
+        ones still in the queue, pass skip=('completed',) to resubmit those'''
+    done = recorded(root, skip)
+    return [fpath for fpath in fpathlist 
+            if os.path.basename(os.path.dirname(fpath)) not in done]
+
+
+
 def submit(fpath, logpath):
     '''executes 
         $ sbatch [script] > [logfile]'''
@@ -68,7 +96,8 @@ def main(root, depth=2,
         tmppath = os.path.join(root, 'tmp.log')
     with open(logpath, 'w') as file: pass
     with open(tmppath, 'w') as file: pass
-    fpathlist = exhaust(root, depth, match)
+    fpathlist = [fpath for fpath in pending(root, exhaust(root, depth, match))
+                 if os.path.dirname(fpath) != root]
     for fpath in fpathlist:
         submit(fpath, tmppath)
         with open(tmppath, 'r') as ftmp:
@@ -81,7 +110,220 @@ def main(root, depth=2,
 
 
 
+def read_ntasks(fpath, default=1):
+    '''reads the number of tasks from the line like
+        #SBATCH -n 32'''
+    with open(fpath, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if not line.startswith('#SBATCH'):
+                continue
+            arg = line.partition(' ')[2].partition('#')[0].strip()
+            if arg.startswith('-n ') or arg.startswith('--ntasks '):
+                return int(arg.split()[1])
+            if arg.startswith('--ntasks='):
+                return int(arg.partition('=')[2])
+    return default
+
+
+
+# the MPI launchers whose lines are replaced by the job step in the packing mode
+MPI_LAUNCHERS = ('mpirun', 'mpiexec', 'mpiexec.hydra', 'srun', 'ibrun')
+# the options of those launchers that take separate values, and how many
+MPI_VALUED = {'-n': 1, '-np': 1, '-N': 1, '-c': 1, '-ppn': 1, '-npernode': 1,
+              '--ntasks': 1, '--nodes': 1, '--cpus-per-task': 1, '-m': 1,
+              '--distribution': 1, '--cpu-bind': 1, '--bind-to': 1, 
+              '--map-by': 1, '--rank-by': 1, '-hostfile': 1, '--hostfile': 1,
+              '-machinefile': 1, '-f': 1, '-x': 1, '-genv': 2, '-mca': 2, 
+              '--mca': 2}
+
+
+
+def step_script(text, step):
+    '''replaces the launcher (along with its options) of every MPI launch 
+        in the script text by step, the program and the rest stay, e.g.
+            mpirun -np $SLURM_NTASKS ~/VASP/vasp.5.4.4.std > vasp.out
+        becomes
+            srun --exact -n 16 --cpu-bind=cores ~/VASP/vasp.5.4.4.std > vasp.out
+        returns (new text, number of launches replaced)'''
+    lines, count = [], 0
+    for line in text.splitlines(True):
+        words = [(m.start(), m.group()) for m in re.finditer(r'\S+', line)]
+        if not words or words[0][1] not in MPI_LAUNCHERS:
+            lines.append(line)
+            continue
+        i = 1
+        while i < len(words) and words[i][1].startswith('-'):
+            i += 1 + MPI_VALUED.get(words[i][1], 0)
+        if i >= len(words):
+            lines.append(line)
+            continue
+        lines.append(line[:words[0][0]] + step + ' ' + line[words[i][0]:])
+        count += 1
+    return ''.join(lines), count
+
+
+
+class PackedRunner:
+    '''
+    runs many sublevel scripts concurrently inside one allocation,
+    queued scripts are started as soon as enough cores are free.
+    each script is started once by the launcher, with SLURM_NTASKS set 
+    to its own "-n", and its MPI launch (e.g. mpirun -np $SLURM_NTASKS vasp) 
+    replaced by step, so that every experiment runs as a job step 
+    on cores of its own, instead of all of them pinned onto the same
+    cores of the first node. the default step 
+        srun --exact -n {ntasks} --cpu-bind=cores
+    needs Slurm 21.08 or later, use "srun --exclusive -n {ntasks} ..." before.
+    step=None runs the scripts unchanged, e.g. off Slurm, 
+    then binding is up to the scripts themselves.
+    the launcher is a format string taking {ntasks} and {script}, 
+    it must start the script only once, e.g.
+        bash {script}                       (default)
+    but never "srun -n {ntasks} bash {script}", which runs ntasks copies of it.
+    a script asking for more than ncores is skipped, or run on all ncores
+    if clamp is set, echo writes every exit status to stdout
+    '''
+    def __init__(self, ncores, 
+                 step='srun --exact -n {ntasks} --cpu-bind=cores',
+                 launcher='bash {script}', 
+                 interval=5.0, outname='job_pack', 
+                 clamp=False, echo=True):
+        self.ncores = ncores
+        self.step = step
+        self.launcher = launcher
+        self.interval = interval
+        self.outname = outname
+        self.clamp = clamp
+        self.echo = echo
+        self.status = {}
+
+    def run(self, fpathlist, logpath=None):
+        '''runs all scripts, returns a dict of {script path: exit status},
+            scripts requesting more cores than available get the status None'''
+        queue = []
+        for fpath in fpathlist:
+            ntasks = read_ntasks(fpath)
+            if ntasks > self.ncores and self.clamp:
+                ntasks = self.ncores
+            if ntasks > self.ncores:
+                self._record(fpath, None, logpath)
+            else:
+                queue.append((ntasks, fpath))
+        # largest first, smaller ones fill the gaps
+        queue.sort(key=lambda job: -job[0])
+        running = {}
+        free = self.ncores
+        while queue or running:
+            for job in list(queue):
+                if job[0] <= free:
+                    queue.remove(job)
+                    running[job[1]] = (job[0], self._launch(*job))
+                    free -= job[0]
+            for fpath, (ntasks, proc) in list(running.items()):
+                code = proc.poll()
+                if code is not None:
+                    del running[fpath]
+                    free += ntasks
+                    self._record(fpath, code, logpath)
+            if running:
+                time.sleep(self.interval)
+        return self.status
+
+    def _launch(self, ntasks, fpath):
+        fdir = os.path.dirname(os.path.abspath(fpath))
+        script = os.path.abspath(fpath)
+        if self.step:
+            with open(fpath, 'r') as file:
+                text, count = step_script(file.read(), 
+                                          self.step.format(ntasks=ntasks))
+            if count:
+                # not named *.sh, so that main() never submits it
+                script = os.path.join(fdir, self.outname+'.run')
+                with open(script, 'w') as file:
+                    file.write(text)
+        cmd = self.launcher.format(ntasks=ntasks, script=script)
+        env = dict(os.environ)
+        env['SLURM_NTASKS'] = str(ntasks)
+        fout = open(os.path.join(fdir, self.outname+'.out'), 'w')
+        ferr = open(os.path.join(fdir, self.outname+'.err'), 'w')
+        try:
+            return subprocess.Popen(cmd, shell=True, cwd=fdir, env=env,
+                                    stdout=fout, stderr=ferr)
+        finally:
+            fout.close()
+            ferr.close()
+
+    def _record(self, fpath, code, logpath):
+        self.status[fpath] = code
+        message = '{} \t{}\n'.format(code, fpath)
+        if self.echo:
+            sys.stdout.write(message)
+        if logpath is not None:
+            with open(logpath, 'a') as flog:
+                flog.write(message)
+
+
+
+def write_pack_script(root, ncores, nodes=1, runtime='0-01:00', 
+                      partition='shared', mem_per_cpu=4000, 
+                      job_name='pack', fname='pack.slurm', 
+                      modules=(), pyexe='python', 
+                      step=None, launcher=None):
+    '''writes one allocation script at the root that runs 
+        this script in the packing mode, it is not named *.sh 
+        so that main() never submits it along with the experiments,
+        step and launcher are passed to the PackedRunner if given,
+        step='' runs the scripts unchanged'''
+    lines = [
+        '#!/bin/bash',
+        '#SBATCH --job-name={}'.format(job_name),
+        '#SBATCH -n {}\t# Number of cores requested'.format(ncores),
+        '#SBATCH -N {}\t# number of nodes'.format(nodes),
+        '#SBATCH -t {}\t# Runtime in d-HH:MM'.format(runtime),
+        '#SBATCH -p {}\t# Partition to submit to'.format(partition),
+        '#SBATCH --mem-per-cpu={}\t# Memory per cpu in MB'.format(mem_per_cpu),
+        '#SBATCH -o job_%j.out\t# Standard out goes to this file',
+        '#SBATCH -e job_%j.err\t# Standard err goes to this file',
+        '',
+    ]
+    if modules:
+        lines += list(modules) + ['']
+    command = '{} {} pack $SLURM_NTASKS'.format(
+        pyexe, os.path.basename(os.path.abspath(__file__)))
+    for key, value in [('step', step), ('launcher', launcher)]:
+        if value is not None:
+            command += " '--{}={}'".format(key, value.replace("'", "'\\''"))
+    lines.append(command)
+    fpath = os.path.join(root, fname)
+    with open(fpath, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    return fpath
+
+
+
+def pack_main(root, ncores, depth=2, 
+              match=lambda fn:fn.endswith('.sh'), 
+              logpath=None, **kwargs):
+    '''the packing mode of main(), runs inside one allocation'''
+    if logpath is None:
+        logpath = os.path.join(root, 'pack.log')
+    with open(logpath, 'w') as file: pass
+    fpathlist = [fpath for fpath in pending(root, exhaust(root, depth, match))
+                 if os.path.dirname(fpath) != root]
+    runner = PackedRunner(ncores, **kwargs)
+    return runner.run(fpathlist, logpath)
+
+
+
 if __name__ == '__main__':
-    main(root=os.getcwd(), depth=2, match=lambda fn:fn.endswith('.sh'))
+    if len(sys.argv) > 2 and sys.argv[1] == 'pack':
+        # e.g. pack 64 '--step=srun --exclusive -n {ntasks}'
+        options = dict(arg[2:].partition('=')[::2] for arg in sys.argv[3:]
+                       if arg[2:].partition('=')[0] in ('step', 'launcher'))
+        pack_main(root=os.getcwd(), ncores=int(sys.argv[2]), depth=2, 
+                  match=lambda fn:fn.endswith('.sh'), **options)
+    else:
+        main(root=os.getcwd(), depth=2, match=lambda fn:fn.endswith('.sh'))
 
 
@@ -47,10 +47,10 @@ class Parser:
     def view(self, key):
         return self.contents[key]
     @classmethod
-    def load(cls, fpath):
+    def load(cls, fpath, *args, **kwargs):
         with open(fpath, 'r') as file:
             flines = file.readlines()
-        return cls(flines)
+        return cls(flines, *args, **kwargs)
     @classmethod
     def parse(cls, flines, *args, **kwargs):
         raise NotImplementedError
@@ -130,7 +130,9 @@ class KVPFile(AlterableFile):
 
     def view(self, key):
         return self.contents[key][1]
-    def alter(self, configs={}, mutes=[], **kwargs):
+    def alter(self, configs={}, mutes=[], append=False, **kwargs):
+        '''only the keys in the file are altered, 
+            unless append, which adds the others after the last key'''
         configs_ = {str(k):str(v) for k,v in configs.items()}
         mutes_ = [str(k) for k in mutes]
         newdict = {}
@@ -144,8 +146,36 @@ class KVPFile(AlterableFile):
                 newlines[i] = self.mute_line(newlines[i])
             else:
                 newlines[i] = self.make_config(key, val, info)
+        missing = [k for k in sorted(configs_) if k not in self.contents]
+        if append and missing:
+            if self.contents:
+                at = max([i for i, _, _ in self.contents.values()]) + 1
+            else:
+                at = 1 if newlines and newlines[0].startswith('#!') else 0
+            if at > 0 and not newlines[at-1].endswith('\n'):
+                newlines[at-1] += '\n'
+            added = [self.make_config(k, configs_[k], '') for k in missing]
+            added = [line if line.endswith('\n') else line + '\n' for line in added]
+            newlines[at:at] = added
         return newlines
     @classmethod
+    def peek(cls, fpath, keys):
+        '''reads only the values of keys from a file, 
+            stops as soon as all of them are found'''
+        keys = set(keys)
+        result = {}
+        if not keys:
+            return result
+        with open(fpath, 'r') as file:
+            for line in file:
+                if cls.is_config(line):
+                    key, val, info = cls.parse_config(line)
+                    if key in keys:
+                        result[key] = val
+                        if len(result) == len(keys):
+                            break
+        return result
+    @classmethod
     def parse(cls, flines, *args, **kwargs):
         result = {}
         for i, line in enumerate(flines):
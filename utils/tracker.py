@@ -0,0 +1,323 @@
+'''
+Completion tracker for experiment sets
+reports each experiment as soon as its job ends, by watching the job outputs
+(vasp.out, job_%j.out, job_%j.err) instead of opening every OUTCAR,
+inotify is used where the set is on a local file system, otherwise polling
+kept free of numpy, so that it can run along with the job on a login node
+'''
+
+import os, sys, time, fnmatch, select, struct
+import concurrent.futures
+from utils import slurm
+from utils.manifest import SetManifest
+try:
+    import ctypes, ctypes.util
+except ImportError:
+    ctypes = None
+
+
+
+# file systems where the writes from compute nodes are invisible to inotify
+NETWORK_FS = ('nfs', 'nfs4', 'lustre', 'gpfs', 'cifs', 'smb3', 'smbfs',
+              'beegfs', 'panfs', 'ceph', 'fuse.sshfs', 'afs')
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CLOEXEC = 0o2000000
+
+
+
+class CompletionTracker:
+    '''watches the experiments of a set and emits (status, exp_dir)
+        once each of them ends, where status is 'completed' or 'failed'
+        (the same as in the SetManifest), the designed syntax is like:
+
+            tracker = CompletionTracker(set_dir, callback=resubmit_or_analyze)
+            tracker.run()
+
+        set_dir:    the root directory where the experiment set is organized
+        callback:   (optional) called as callback(status, exp_dir)
+        queue:      (optional) receives (status, exp_dir) by put
+        exp_names:  the experiments to watch, by default the submitted ones
+                    in the manifest, or every experiment with a batch.sh
+        interval:   the seconds between the polling rounds
+        nworkers:   the number of threads that scan the directories
+        inotify:    None to decide by the file system, or True/False
+
+        an experiment is completed once its OUTCAR ends with the timing
+        informations, and failed once a FAILURES marker shows up at the end
+        of its job outputs, only the experiments whose outputs changed
+        are checked, and the outputs are named as in batch.sh.
+        only the outputs of the current job count, that is the job files of
+        the jobid in the manifest, and the files modified since the submission
+        time in the manifest (or since batch.sh was written, if not recorded),
+        so that the leftovers of an earlier run in the same directory are ignored'''
+
+    BATCH = 'batch.sh'
+    OUTCAR = 'OUTCAR'
+    STDOUT = 'vasp.out'
+    FINISHED = b'General timing and accounting'
+    FAILURES = [b'CANCELLED', b'DUE TO TIME LIMIT', b'BAD TERMINATION',
+                b'Segmentation fault', b'oom-kill', b'Out Of Memory',
+                b'forrtl: severe', b'VERY BAD NEWS', b'srun: error',
+                b'Killed']
+
+    def __init__(self, set_dir, callback=None, queue=None, exp_names=None,
+                 interval=30., nworkers=8, inotify=None, tail=4096):
+        self.set_dir = os.path.abspath(set_dir)
+        self.callback = callback
+        self.queue = queue
+        self.interval = interval
+        self.nworkers = nworkers
+        self.tail = tail
+        manifest = SetManifest(self.set_dir)
+        if exp_names is None:
+            exp_names = manifest.query(status='submitted')
+        if not exp_names:
+            exp_names = sorted(entry.name for entry in os.scandir(self.set_dir)
+                               if entry.is_dir() and
+                               os.path.isfile(os.path.join(entry.path, self.BATCH)))
+        self.pending = set(exp_names)
+        self.jobs = {exp_name: (record.get('jobid'), record.get('submitted'))
+                     for exp_name, record in manifest.records.items()}
+        self.outputs = self.output_names(exp_names)
+        self.patterns = [self.STDOUT, self.OUTCAR] + \
+                        [slurm_pattern(fname) for fname in self.outputs]
+        if inotify is None:
+            inotify = inotify_usable(self.set_dir)
+        self.inotify = inotify
+        self.snapshots = {}
+        self.results = {}
+
+    def output_names(self, exp_names):
+        '''the Slurm filename patterns of the job outputs, read from the 
+            batch.sh of the first experiment, as all of a set share one template'''
+        names = []
+        for exp_name in sorted(exp_names)[:1]:
+            fpath = os.path.join(self.set_dir, exp_name, self.BATCH)
+            if os.path.isfile(fpath):
+                batch = slurm.SlurmBatchScript.load(fpath)
+                for key in ['-o', '--output', '-e', '--error']:
+                    if key in batch.keys():
+                        names.append(batch.view(key))
+        return names or ['job_%j.out', 'job_%j.err']
+
+    def watched(self, fname):
+        return any(fnmatch.fnmatchcase(fname, p) for p in self.patterns)
+
+    def run(self, timeout=None):
+        '''watches until all experiments end or timeout (in seconds),
+            returns {<experiment name>: <status>} of the ended ones'''
+        deadline = None if timeout is None else time.time() + timeout
+        if self.inotify:
+            try:
+                return self.run_inotify(deadline)
+            except OSError:
+                self.inotify = False
+        return self.run_polling(deadline)
+
+    def run_polling(self, deadline):
+        while True:
+            self.poll()
+            if not self.pending or (deadline is not None and time.time() >= deadline):
+                return self.results
+            wait = self.interval
+            if deadline is not None:
+                wait = min(wait, max(deadline - time.time(), 0))
+            time.sleep(wait)
+
+    def poll(self):
+        '''one polling round, the directories are scanned in batches
+            by a thread pool, and only the changed experiments are checked'''
+        exp_names = sorted(self.pending)
+        with concurrent.futures.ThreadPoolExecutor(self.nworkers) as pool:
+            snapshots = list(pool.map(self.scan, exp_names))
+        for exp_name, snapshot in zip(exp_names, snapshots):
+            if snapshot and snapshot != self.snapshots.get(exp_name):
+                self.snapshots[exp_name] = snapshot
+                self.update(exp_name)
+
+    def scan(self, exp_name):
+        '''{<output name>: (size, mtime)} by one os.scandir'''
+        snapshot = {}
+        try:
+            for entry in os.scandir(os.path.join(self.set_dir, exp_name)):
+                if self.watched(entry.name):
+                    st = entry.stat()
+                    snapshot[entry.name] = (st.st_size, st.st_mtime)
+        except FileNotFoundError:
+            pass
+        return snapshot
+
+    def run_inotify(self, deadline):
+        notifier = Inotify()
+        try:
+            wds = {}
+            for exp_name in sorted(self.pending):
+                wd = notifier.add(os.path.join(self.set_dir, exp_name),
+                                  IN_CLOSE_WRITE | IN_MOVED_TO)
+                wds[wd] = exp_name
+            # the jobs that ended before the watches were added
+            self.poll()
+            while self.pending:
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time.time()
+                    if wait <= 0:
+                        break
+                changed = set()
+                for wd, fname in notifier.read(wait):
+                    if wd in wds and self.watched(fname):
+                        changed.add(wds[wd])
+                for exp_name in sorted(changed & self.pending):
+                    self.update(exp_name)
+        finally:
+            notifier.close()
+        return self.results
+
+    def update(self, exp_name):
+        status = self.check(exp_name)
+        if status is not None:
+            self.emit(exp_name, status)
+
+    def check(self, exp_name):
+        '''returns 'completed', 'failed' or None if the job is not over yet'''
+        exp_dir = os.path.join(self.set_dir, exp_name)
+        jobid, since = self.jobs.get(exp_name, (None, None))
+        if since is None:
+            try:
+                since = os.path.getmtime(os.path.join(exp_dir, self.BATCH))
+            except OSError:
+                since = 0.
+        if jobid is None:
+            patterns = self.patterns[2:]
+        else:
+            patterns = [slurm_pattern(fname.replace('%j', str(jobid)))
+                        for fname in self.outputs]
+        def current(fname):
+            try:
+                return os.path.getmtime(os.path.join(exp_dir, fname)) > since
+            except OSError:
+                return False
+        if current(self.OUTCAR) and self.FINISHED in \
+           read_tail(os.path.join(exp_dir, self.OUTCAR), self.tail):
+            return 'completed'
+        try:
+            fnames = [fn for fn in os.listdir(exp_dir) if fn == self.STDOUT or
+                      any(fnmatch.fnmatchcase(fn, p) for p in patterns)]
+        except FileNotFoundError:
+            return None
+        for fname in fnames:
+            if not current(fname):
+                continue
+            text = read_tail(os.path.join(exp_dir, fname), self.tail)
+            if any(marker in text for marker in self.FAILURES):
+                return 'failed'
+        return None
+
+    def emit(self, exp_name, status):
+        self.pending.discard(exp_name)
+        self.results[exp_name] = status
+        exp_dir = os.path.join(self.set_dir, exp_name)
+        if self.callback is not None:
+            self.callback(status, exp_dir)
+        if self.queue is not None:
+            self.queue.put((status, exp_dir))
+
+
+
+class Inotify:
+    '''a minimal inotify binding through ctypes, Linux only'''
+
+    HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        if ctypes is None or not sys.platform.startswith('linux'):
+            raise OSError('inotify is not available')
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', path)
+        return wd
+
+    def read(self, timeout=None):
+        '''waits for the events, returns [(wd, name)]'''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 1 << 16)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, size = self.HEADER.unpack_from(data, offset)
+            offset += self.HEADER.size
+            name = data[offset:offset+size].rstrip(b'\0')
+            offset += size
+            events.append((wd, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+
+def inotify_usable(path):
+    '''whether inotify would see the writes under path, that is
+        on Linux and not on a network file system (by /proc/mounts)'''
+    if ctypes is None or not sys.platform.startswith('linux'):
+        return False
+    path = os.path.realpath(path)
+    fstype, longest = None, -1
+    try:
+        with open('/proc/mounts', 'r') as file:
+            for line in file:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1].replace('\\040', ' ')
+                inside = path == mount or path.startswith(mount.rstrip('/') + '/')
+                if inside and len(mount) > longest:
+                    fstype, longest = fields[2], len(mount)
+    except IOError:
+        return False
+    return fstype is not None and fstype not in NETWORK_FS
+
+
+
+def slurm_pattern(fname):
+    '''job_%j.out -> job_*.out, every Slurm filename pattern becomes *'''
+    result, i = [], 0
+    while i < len(fname):
+        if fname[i] == '%' and i + 1 < len(fname):
+            j = i + 1
+            while j < len(fname) and fname[j].isdigit():
+                j += 1
+            if fname[j:j+1] == '%':
+                result.append('%')
+            else:
+                result.append('*')
+            i = j + 1
+        else:
+            result.append(fname[i])
+            i += 1
+    return ''.join(result)
+
+
+def read_tail(fpath, size):
+    '''the last size bytes of a file, empty if it does not exist'''
+    try:
+        with open(fpath, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            file.seek(max(file.tell() - size, 0))
+            return file.read()
+    except IOError:
+        return b''
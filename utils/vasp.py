@@ -5,6 +5,7 @@ Date:   May 9, 2018
 '''
 
 from utils import template
+import os, re, json, shutil
 import numpy as np
 
 
@@ -28,8 +29,67 @@ class VaspBoolType(template.DataType):
 
 
 
+class VaspArrayType(template.DataType):
+    '''arrays in the VASP syntax with repetitions, like
+            MAGMOM = 2*4.5  6*0.5
+        decodes into numpy arrays, encodes with run-length compression'''
+
+    @classmethod
+    def istype(cls, val):
+        try:
+            cls.decode(val)
+            return True
+        except ValueError:
+            return False
+    @classmethod
+    def decode(cls, val, ncol=None, dtype=float):
+        '''ncol:    if given, reshapes the array into (-1, ncol),
+                    e.g. ncol=3 for the per-atom vectors in non-collinear runs'''
+        counts, values = [], []
+        for token in val.split():
+            n, _, v = token.rpartition('*')
+            counts.append(int(n) if n else 1)
+            values.append(v)
+        arr = np.repeat(np.array(values, dtype=dtype), counts)
+        if ncol is not None:
+            arr = arr.reshape(-1, ncol)
+        return arr
+    @classmethod
+    def encode(cls, pyval, fmt=None):
+        '''a run is written as n*value when that is shorter,
+            fmt:    a format string for the values, by default the shortest 
+                    representation that decodes to the same value'''
+        arr = np.asarray(pyval).ravel()
+        if arr.size == 0:
+            return ''
+        starts = np.concatenate([[0], np.flatnonzero(arr[1:] != arr[:-1]) + 1])
+        counts = np.diff(np.concatenate([starts, [arr.size]]))
+        tokens = []
+        for i, n in zip(starts, counts):
+            v = repr(arr[i].item()) if fmt is None else fmt.format(arr[i])
+            packed = '{}*{}'.format(n, v)
+            if len(packed) < n * (len(v) + 1) - 1:
+                tokens.append(packed)
+            else:
+                tokens.extend([v] * n)
+        return ' '.join(tokens)
+
+
+
 class VaspINCAR(template.KVPFile):
 
+    def view_array(self, key, ncol=None, dtype=float):
+        '''views a value as a numpy array, see VaspArrayType'''
+        return VaspArrayType.decode(self.view(key), ncol, dtype)
+    def alter(self, configs={}, mutes=[], **kwargs):
+        '''lists, tuples and numpy arrays are encoded by VaspArrayType'''
+        configs_ = {}
+        for key, val in configs.items():
+            if isinstance(val, (list, tuple, np.ndarray)):
+                val = VaspArrayType.encode(val)
+            configs_[key] = val
+        return super(VaspINCAR, self).alter(configs_, mutes, **kwargs)
+
     @classmethod
     def is_config(cls, line):
         line = line.strip()
@@ -125,7 +185,7 @@ class VaspPOSCAR(template.FreeFile):
         flines_ = [line.partition('#')[0].strip() for line in flines]
         result['header'] = flines_[0]
         result['scale'] = float(flines_[1])
-        cellmat = np.fromstring(' '.join(flines_[2:4]), sep=' ')
+        cellmat = np.fromstring(' '.join(flines_[2:5]), sep=' ')
         cellmat = cellmat.reshape(3, -1)
         result['cell'] = cellmat
         result['symbols'] = flines_[5].split()
@@ -177,23 +237,179 @@ class VaspPOTCAR(template.CreatableFile):
 
 
 
+class PotcarLibrary:
+    '''a pseudopotential library that is indexed once and assembled by streaming,
+        root:       the library directory laid out as <root>/<name>/POTCAR
+        cachedir:   (optional) where the assembled POTCARs are kept,
+                    otherwise the first output of each combination is reused
+        each dataset is indexed by its byte offsets and TITEL on first use, 
+        the assembled POTCARs are cached by the ordered tuple of names.
+        with a cachedir, both outlive the instance: the offsets are kept in
+        <cachedir>/index.json by the path, size and mtime of each POTCAR,
+        and <cachedir>/<names>.POTCAR is reused while it is newer than 
+        its sources and of the expected size'''
+
+    BUFSIZE = 1 << 20
+    INDEX = 'index.json'
+
+    def __init__(self, root=None, cachedir=None):
+        self.root = root
+        self.cachedir = cachedir
+        self.index = {}
+        self.assembled = {}
+        self.scanned = None
+    def add(self, fpath, names=None):
+        '''indexes all datasets in a (possibly concatenated) POTCAR,
+            the names default to the element symbols in TITEL'''
+        fpath = os.path.abspath(fpath)
+        stat = os.stat(fpath)
+        scanned = self.load_index()
+        entry = scanned.get(fpath)
+        if entry is not None and entry['size'] == stat.st_size \
+           and entry['mtime'] == stat.st_mtime_ns:
+            datasets = [tuple(d) for d in entry['datasets']]
+        else:
+            datasets = self.scan(fpath)
+            scanned[fpath] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                              'datasets': datasets}
+            self.save_index()
+        if names is None:
+            names = [title.split()[1] for _, _, title in datasets]
+        for name, (start, end, title) in zip(names, datasets):
+            self.index[name] = (fpath, start, end, title)
+        return names
+    @staticmethod
+    def scan(fpath):
+        '''returns [(start, end, title)] of the datasets in a POTCAR'''
+        datasets = []
+        start, title = 0, None
+        with open(fpath, 'rb') as file:
+            offset = 0
+            for line in file:
+                offset += len(line)
+                stripped = line.strip()
+                if stripped.startswith(b'TITEL'):
+                    title = stripped.partition(b'=')[-1].strip().decode()
+                elif stripped.startswith(b'End of Dataset'):
+                    datasets.append((start, offset, title))
+                    start, title = offset, None
+        return datasets
+    def load_index(self):
+        '''{<POTCAR path>: {'size', 'mtime', 'datasets'}} kept in the cachedir'''
+        if self.scanned is None:
+            self.scanned = {}
+            if self.cachedir is not None:
+                fpath = os.path.join(self.cachedir, self.INDEX)
+                if os.path.isfile(fpath):
+                    with open(fpath, 'r') as file:
+                        self.scanned = json.load(file)
+        return self.scanned
+    def save_index(self):
+        if self.cachedir is None:
+            return
+        os.makedirs(self.cachedir, exist_ok=True)
+        fpath = os.path.join(self.cachedir, self.INDEX)
+        tmppath = '{}.{}.tmp'.format(fpath, os.getpid())
+        with open(tmppath, 'w') as file:
+            json.dump(self.scanned, file, sort_keys=True)
+        os.rename(tmppath, fpath)
+    def locate(self, name):
+        '''returns (fpath, start, end, title) of a dataset'''
+        if name not in self.index:
+            if self.root is None:
+                raise KeyError('{} is not indexed'.format(name))
+            self.add(os.path.join(self.root, name, 'POTCAR'), [name])
+        return self.index[name]
+    def contents(self, names):
+        '''works as VaspPOTCAR.parse without reading the POTCAR'''
+        titles = [self.locate(name)[3] for name in names]
+        return {'titles':titles, 'symbols':[t.split()[1] for t in titles]}
+    def assemble(self, names, dest):
+        '''writes the POTCAR of the names in order to dest'''
+        key = tuple(names)
+        cached = self.assembled.get(key)
+        if cached is None and self.cachedir is not None:
+            cached = self.cached(key)
+        if cached is not None and os.path.isfile(cached[0]) \
+           and os.path.getsize(cached[0]) == cached[1]:
+            self.assembled[key] = cached
+            if os.path.abspath(dest) != cached[0]:
+                shutil.copyfile(cached[0], dest)
+            return dest
+        target = dest
+        if self.cachedir is not None:
+            os.makedirs(self.cachedir, exist_ok=True)
+            target = os.path.join(self.cachedir, '_'.join(key) + '.POTCAR')
+        # written through a rename, as other processes may share the cachedir
+        tmppath = '{}.{}.tmp'.format(target, os.getpid())
+        size = self.stream(key, tmppath)
+        os.rename(tmppath, target)
+        self.assembled[key] = (os.path.abspath(target), size)
+        if target != dest:
+            shutil.copyfile(target, dest)
+        return dest
+    def cached(self, names):
+        '''(path, size) of the POTCAR left in the cachedir by an earlier session,
+            None if missing or older than any of its sources'''
+        fpath = os.path.abspath(os.path.join(self.cachedir, '_'.join(names) + '.POTCAR'))
+        if not os.path.isfile(fpath):
+            return None
+        located = [self.locate(name) for name in names]
+        mtime = os.path.getmtime(fpath)
+        if any(os.path.getmtime(src) > mtime for src, _, _, _ in located):
+            return None
+        return fpath, sum(end - start for _, start, end, _ in located)
+    def stream(self, names, dest):
+        '''concatenates the datasets with buffered copies, returns the size'''
+        size = 0
+        with open(dest, 'wb') as fout:
+            for name in names:
+                fpath, start, end, _ = self.locate(name)
+                with open(fpath, 'rb') as fin:
+                    fin.seek(start)
+                    remain = end - start
+                    while remain > 0:
+                        buf = fin.read(min(self.BUFSIZE, remain))
+                        if not buf:
+                            break
+                        fout.write(buf)
+                        remain -= len(buf)
+                        size += len(buf)
+        return size
+
+
+
 class VaspOUTCAR(template.Parser):
 
-    _default = ['spacegroup', 'uniquekpoints', 'energy', 'niter', 'mag']
+    _default = ['spacegroup', 'uniquekpoints', 'nbands', 'energy', 'niter', 'mag']
+    _timing = ['ncores', 'kpar', 'npar', 
+               'looptimes', 'ionictimes', 
+               'cputime', 'elapsed', 'maxmem']
+    _history = ['natoms', 'nsteps', 
+                'energies', 'forces', 'positions', 'stresses', 'mags']
+    _float = re.compile(r'-?\d+\.\d*(?:[eE][-+]?\d+)?')
 
-    def __init__(self, flines, magnetic=True):
-        self.contents = self.parse(flines, magnetic)
+    def __init__(self, flines, magnetic=True, timing=True, history=False):
+        self.contents = self.parse(flines, magnetic, timing, history)
 
     @classmethod
-    def parse(cls, flines, magnetic=True, **kwargs):
+    def parse(cls, flines, magnetic=True, timing=True, history=False, **kwargs):
         result = {}
         # space group, number of unique kpoints
         for line in flines:
             line = line.strip()
+            if timing and line.startswith('running on'):
+                result['ncores'] = int(line.split()[2])
+            if timing and line.startswith('distrk:'):
+                result['kpar'] = cls.parse_groups(line)
+            if timing and line.startswith('distr:'):
+                result['npar'] = cls.parse_groups(line)
             if 'full space group' in line:
                 result['spacegroup'] = line.rstrip(' .').split()[-1]
             if 'irreducible k-points:' in line:
                 result['uniquekpoints'] = int(line.split()[1])
+            if 'NBANDS=' in line:
+                result['nbands'] = int(line.split()[-1])
                 break
         # total energy
         for line in flines[::-1]:
@@ -224,8 +440,103 @@ class VaspOUTCAR(template.Parser):
             magy = cls.parse_matrix_inblock(flines[cursor_y:cursor_y+stride])[:,-1]
             magz = cls.parse_matrix_inblock(flines[cursor_z:cursor_z+stride])[:,-1]
             result['mag'] = np.vstack([magx, magy, magz]).T
+        # timing and memory
+        if timing:
+            result.update(cls.parse_timing(flines))
+        # ionic history
+        if history:
+            result.update(cls.parse_history(flines))
+        return result
+
+    @classmethod
+    def load_history(cls, fpath):
+        '''streams the ionic history out of the file without reading it all'''
+        with open(fpath, 'r') as file:
+            return cls.parse_history(file)
+
+    @classmethod
+    def parse_history(cls, flines):
+        '''collects the energy, forces, positions, stress (in kB) and 
+            magnetization of every ionic step in one forward pass,
+            flines can be any iterable of lines, e.g. an opened file.
+            the magnetization takes the 'tot' column of the x, y, z blocks,
+            only x is filled in collinear runs.
+            each quantity is written in place into a GrowableArray 
+            at the index of the current ionic step'''
+        natoms = None
+        nsteps = 0
+        energies = GrowableArray()
+        stresses = GrowableArray((6,))
+        forces = positions = mags = None
+        lines = iter(flines)
+        for line in lines:
+            line = line.strip()
+            if natoms is None:
+                if 'NIONS =' in line:
+                    natoms = int(line.split()[-1])
+                    forces = GrowableArray((natoms, 3))
+                    positions = GrowableArray((natoms, 3))
+                    mags = GrowableArray((natoms, 3))
+                continue
+            if line.startswith('free  energy   TOTEN'):
+                energies.put(nsteps, float(line.split()[-2]))
+                nsteps += 1
+            elif line.startswith('in kB'):
+                stresses.put(nsteps, [float(v) for v in 
+                                      cls._float.findall(line)])
+            elif line.startswith('POSITION') and 'TOTAL-FORCE' in line:
+                next(lines)
+                frow, prow = forces.row(nsteps), positions.row(nsteps)
+                for i in range(natoms):
+                    vals = next(lines).split()
+                    prow[i] = [float(v) for v in vals[:3]]
+                    frow[i] = [float(v) for v in vals[3:6]]
+            elif line.startswith('magnetization (') and line[-1] == ')':
+                axis = 'xyz'.index(line[-2])
+                for header in lines:
+                    if header.strip().startswith('# of ion'):
+                        break
+                next(lines)
+                mrow = mags.row(nsteps)
+                for i in range(natoms):
+                    mrow[i, axis] = float(next(lines).split()[-1])
+        result = {'natoms': natoms, 'nsteps': nsteps, 
+                  'energies': energies.view(nsteps),
+                  'stresses': stresses.view(nsteps)}
+        for key, arr in [('forces', forces), ('positions', positions), 
+                         ('mags', mags)]:
+            result[key] = None if arr is None else arr.view(nsteps)
+        return result
+
+    @classmethod
+    def parse_timing(cls, flines):
+        '''collects the real time of each electronic (LOOP) 
+            and ionic (LOOP+) step, together with the general 
+            timing and accounting informations at the end of the job'''
+        result = {}
+        looptimes, ionictimes = [], []
+        for line in flines:
+            line = line.strip()
+            if line.startswith('LOOP:'):
+                looptimes.append(float(line.split()[-1]))
+            elif line.startswith('LOOP+:'):
+                ionictimes.append(float(line.split()[-1]))
+            elif line.startswith('Total CPU time used (sec):'):
+                result['cputime'] = float(line.split()[-1])
+            elif line.startswith('Elapsed time (sec):'):
+                result['elapsed'] = float(line.split()[-1])
+            elif line.startswith('Maximum memory used (kb):'):
+                result['maxmem'] = float(line.split()[-1])
+        result['looptimes'] = np.array(looptimes)
+        result['ionictimes'] = np.array(ionictimes)
         return result
 
+    @staticmethod
+    def parse_groups(line):
+        '''reads the number of groups in lines like
+            distrk:  each k-point on    8 cores,    4 groups'''
+        return int(line.rpartition(',')[2].split()[0])
+
     @staticmethod
     def parse_matrix_inblock(blocklines, matsep='--', elesep=' '):
         mat_raw = ''.join(blocklines).split(matsep)
@@ -233,4 +544,29 @@ class VaspOUTCAR(template.Parser):
         mat_raw = [s.strip() for s in mat_raw.splitlines()]
         mat = np.fromstring(elesep.join(mat_raw), sep=elesep)
         mat = mat.reshape(len(mat_raw), -1)
-        return mat
\ No newline at end of file
+        return mat
+
+
+
+class GrowableArray:
+    '''a preallocated numpy array that grows along the first axis,
+        the capacity doubles whenever a row beyond it is requested'''
+
+    def __init__(self, shape=(), dtype=float, capacity=64):
+        self.data = np.zeros((capacity,) + tuple(shape), dtype=dtype)
+    def row(self, i):
+        '''returns a writable view of row i (not for 1D arrays), 
+            grows if necessary'''
+        self.reserve(i + 1)
+        return self.data[i]
+    def put(self, i, val):
+        self.reserve(i + 1)
+        self.data[i] = val
+    def reserve(self, n):
+        if n > len(self.data):
+            capacity = max(2 * len(self.data), n)
+            data = np.zeros((capacity,) + self.data.shape[1:], dtype=self.data.dtype)
+            data[:len(self.data)] = self.data
+            self.data = data
+    def view(self, n):
+        return self.data[:n]